@@ -3,19 +3,31 @@
 # also dynamically imports ansible in code
 
 import argparse
+import ast
+import asyncio
+import bisect
+import concurrent.futures
 import configparser
 import contextlib
+import fcntl
 import functools
 import glob
+import hashlib
 import importlib.util
+import inspect
 import itertools
 import logging
+import multiprocessing
 import os
+import pickle
 import re
 import shutil
+import stat
 import subprocess
 import sys
+import tempfile
 import textwrap
+import tokenize
 import yaml
 
 from collections import defaultdict, Counter
@@ -39,15 +51,19 @@ from baron.parser import ParsingError
 import redbaron
 
 import backoff
+from aiohttp.client import ClientSession
 
-from gh import GitHubOrgClient
-from rsa_utils import RSAKey
+from profiling_utils import RunTimer, profile_into
+from rsa_utils import KEY_TYPES, EphemeralSSHKey
+from splice_utils import SourceSplicer, UnsupportedSourceLayout
 from template_utils import render_template_into
 
 
 # CONSTANTS/SETTINGS
 
 # https://github.com/ansible/ansible/blob/100fe52860f45238ee8ca9e3019d1129ad043c68/hacking/fix_test_syntax.py#L62
+# lookup('name', ...), query("name", ...) or q('name', ...) in Jinja2 expressions
+JINJA_LOOKUP_CALL_RE = re.compile(r'''(?P<call>(?<![\w.])(?:lookup|query|q)\(\s*(?P<quote>['"]))(?P<name>\w+)(?P=quote)''')
 FILTER_RE = re.compile(r'((.+?)\s*([\w \.\'"]+)(\s*)\|(\s*)(\w+))')
 TEST_RE = re.compile(r'((.+?)\s*([\w \.\'"]+)(\s*)is(\s*)(\w+))')
 DEFAULT_VERSION = '0.1.0'
@@ -59,6 +75,30 @@ ALL_THE_FILES = set()
 
 CLEANUP_FILES = set(['contrib/README.md'])
 
+SH_KEY_MAP = {
+    'ANSIBLE_CACHE_PLUGIN': 'cache',
+    'ANSIBLE_CALLBACK_WHITELIST': 'callback',
+    'ANSIBLE_INVENTORY_CACHE_PLUGIN': 'cache',
+    'ANSIBLE_STDOUT_CALLBACK': 'callback',
+    'ANSIBLE_STRATEGY': 'strategy',
+    '--become-method': 'become',
+    '-c': 'connection',
+    '--connection': 'connection',
+}
+
+LINK_MODES = ('copy', 'hardlink', 'reflink')
+FICLONE = 0x40049409  # from linux/fs.h
+LINK_COPY_METADATA_FUNCS = {
+    shutil.copyfile: None,
+    shutil.copy: shutil.copymode,
+    shutil.copy2: shutil.copystat,
+}
+SANITY_IGNORE_REL_PATH = 'test/sanity/ignore.txt'
+
+NULL_GIT_SHA = '0' * 40
+
+GLOB_MAGIC_RE = re.compile(r'[*?[]')
+
 COLLECTION_NAMESPACE = 'test_migrate_ns'
 PLUGIN_EXCEPTION_PATHS = {'modules': 'lib/ansible/modules', 'module_utils': 'lib/ansible/module_utils', 'inventory_scripts': 'contrib/inventory', 'vault': 'contrib/vault', 'unit': 'test/units', 'integration': 'test/integration/targets'}
 PLUGIN_DEST_EXCEPTION_PATHS = {'inventory_scripts': 'scripts/inventory', 'vault': 'scripts/vault', 'unit': 'tests/unit', 'integration': 'tests/integration/targets'}
@@ -128,8 +168,21 @@ REWRITE_CLASS_PROPERTY_PLUGINS = {
     'inventory',
 }
 
+REWRITE_IMPORT_PREFIXES = (
+    ('ansible', 'modules'),
+    ('ansible', 'module_utils'),
+    ('ansible', 'plugins'),
+    ('units', ),
+)
+
+UNIT_TESTS_PATCH_NEEDLES = ('ansible.modules', 'ansible.module_utils', 'ansible.plugins', 'units')
+
+DOCUMENTATION_REWRITE_NEEDLES = ('version_added', 'extends_documentation_fragment', 'seealso')
+
 VARDIR = os.environ.get('GRAVITY_VAR_DIR', '.cache')
 LOGFILE = os.path.join(VARDIR, 'errors.log')
+TIMINGS_TOP_N = 50
+CHECKPOINTS_JOURNAL_REL_PATH = os.path.join('checkpoints', 'journal.pickle')
 
 ALIAS = {}
 DEPRECATE = {}
@@ -139,6 +192,28 @@ REMOVE = defaultdict(lambda: defaultdict(set))
 core = {}
 manual_check = defaultdict(list)
 
+# how many Python files were copied as is or rewritten, per rewrite path
+rewrite_paths = Counter()
+
+# wall time spent in the migration phases
+run_timer = RunTimer()
+
+# (plugin_type, plugin) -> (namespace, collection) lookups, see build_plugin_index
+PLUGIN_INDEX = {}
+
+# global state updates made by the rewrite currently being cached, see cached_rewrite
+REWRITE_SIDE_EFFECTS = []
+REWRITE_SIDE_EFFECT_FUNCS = frozenset({'add_core', 'add_manual_check', 'integration_tests_add_to_deps'})
+# the local modules the rewrite functions call into, see get_migrator_digest
+REWRITE_HELPER_MODULES = ('splice_utils',)
+
+# plugin_type -> {jinja2 filter/test name: (namespace, collection)}, see get_jinja_plugin_map
+JINJA_PLUGIN_MAPS = {}
+JINJA_PLUGIN_CLASSES = {
+    'filter': ('FilterModule', 'filters'),
+    'test': ('TestModule', 'tests'),
+}
+
 ### CLASSES
 
 
@@ -148,25 +223,38 @@ class UnmovablePathStr(str): ...
 ### FUNCTION DEFS
 
 def log_subprocess_failure(func):
+    if inspect.iscoroutinefunction(func):
+        async def async_func_wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except subprocess.CalledProcessError as proc_err:
+                _log_subprocess_failure(proc_err)
+                raise
+        return async_func_wrapper
+
     def func_wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
         except subprocess.CalledProcessError as proc_err:
-            proc_id = hex(id(proc_err))
-            logger.error(
-                '[%s] Running "%s" failed with return code %s',
-                proc_id,
-                proc_err.cmd,
-                proc_err.returncode,
-            )
-            logger.error('[%s] stderr:', proc_id)
-            logger.error(proc_err.stderr)
-            logger.error('[%s] stdout:', proc_id)
-            logger.error(proc_err.stdout)
+            _log_subprocess_failure(proc_err)
             raise
     return func_wrapper
 
 
+def _log_subprocess_failure(proc_err):
+    proc_id = hex(id(proc_err))
+    logger.error(
+        '[%s] Running "%s" failed with return code %s',
+        proc_id,
+        proc_err.cmd,
+        proc_err.returncode,
+    )
+    logger.error('[%s] stderr:', proc_id)
+    logger.error(proc_err.stderr)
+    logger.error('[%s] stdout:', proc_id)
+    logger.error(proc_err.stdout)
+
+
 def _is_unexpected_error(proc_err):
     proc_id = hex(id(proc_err))
     err_out = proc_err.stderr
@@ -206,6 +294,34 @@ def ensure_cmd_succeeded(ssh_agent, cmd, cwd):
     print(cmd_out)
 
 
+@log_subprocess_failure
+@retry_on_permission_denied
+async def ensure_cmd_succeeded_async(ssh_agent, cmd, cwd, cmd_repr=None):
+    """Perform cmd in cwd dir in an asyncio subprocess.
+
+    ``cmd_repr`` replaces cmd in the logs when it holds secrets.
+    """
+    cmd_repr = cmd if cmd_repr is None else cmd_repr
+    logger.info('Executing "%s"...', ' '.join(cmd_repr))
+    proc = await ssh_agent.create_subprocess_exec(
+        *cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    cmd_out, cmd_err = await proc.communicate()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(
+            proc.returncode, cmd_repr, output=cmd_out.decode(), stderr=cmd_err.decode(),
+        )
+    print(cmd_out.decode())
+
+
+class NoSSHAgent:
+    """Stand-in for the SSH agent proxy of the pushes that don't use SSH."""
+
+    @staticmethod
+    def create_subprocess_exec(*args, **kwargs):
+        return asyncio.create_subprocess_exec(*args, **kwargs)
+
+
 def add_core(ptype, name):
 
     global core
@@ -213,11 +329,13 @@ def add_core(ptype, name):
         core[ptype] = set()
 
     core[ptype].add(name)
+    record_rewrite_side_effect('add_core', ptype, name)
 
 
 def add_manual_check(key, value, filename):
     global manual_check
     manual_check[filename].append((key, value))
+    record_rewrite_side_effect('add_manual_check', key, value, filename)
 
 
 def checkout_repo(git_url: str, checkout_path: str, *, refresh: bool = False) -> Set[str]:
@@ -251,6 +369,71 @@ def checkout_repo(git_url: str, checkout_path: str, *, refresh: bool = False) ->
     )
 
 
+def _fast_import_quote_path(path: str) -> bytes:
+    """Quote the path the way git fast-import expects in C-style."""
+    quoted = path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return b'"%s"' % quoted.encode('utf-8', errors='surrogateescape')
+
+
+def git_init_with_fast_import(repo_dir: str, message: str) -> None:
+    """Commit the whole work tree of a new or existing repo using git fast-import.
+
+    Unlike ``git add`` + ``git commit`` this does not build the index
+    up front: every blob is streamed into a single fast-import process
+    which hashes and stores it once. In an existing repo, the commit
+    goes on top of HEAD and records the files deleted since, like
+    ``git add .`` does.
+    """
+    subprocess.check_call(('git', 'init', '--quiet'), cwd=repo_dir)
+
+    head_ref = subprocess.check_output(('git', 'symbolic-ref', 'HEAD'), cwd=repo_dir).strip()
+    parent = subprocess.run(
+        ('git', 'rev-parse', '--verify', '--quiet', 'HEAD'),
+        stdout=subprocess.PIPE, cwd=repo_dir,
+    ).stdout.strip()
+    author = subprocess.check_output(('git', 'var', 'GIT_AUTHOR_IDENT'), cwd=repo_dir).strip()
+    committer = subprocess.check_output(('git', 'var', 'GIT_COMMITTER_IDENT'), cwd=repo_dir).strip()
+    # NOTE: ls-files only stats the tree and applies .gitignore, it hashes nothing
+    paths = sorted(
+        p for p in set(subprocess.check_output(
+            ('git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'), cwd=repo_dir,
+        ).decode('utf-8', errors='surrogateescape').split('\0'))
+        # tracked files deleted from the work tree are left out of the commit
+        if p and os.path.lexists(os.path.join(repo_dir, p))
+    )
+    message = message.encode('utf-8')
+
+    logger.info('Streaming %d files into git fast-import in %s', len(paths), repo_dir)
+    fast_import_cmd = 'git', 'fast-import', '--quiet', '--done'
+    with subprocess.Popen(fast_import_cmd, stdin=subprocess.PIPE, cwd=repo_dir) as fast_import:
+        stream = fast_import.stdin
+        stream.write(b'commit %s\nauthor %s\ncommitter %s\ndata %d\n%s\n' % (head_ref, author, committer, len(message), message))
+        if parent:
+            # the commit lists the whole tree, not the changes since the parent
+            stream.write(b'from %s\ndeleteall\n' % parent)
+        for path in paths:
+            full_path = os.path.join(repo_dir, path)
+            path_stat = os.lstat(full_path)
+            if stat.S_ISLNK(path_stat.st_mode):
+                mode = b'120000'
+                contents = os.fsencode(os.readlink(full_path))
+            else:
+                mode = b'100755' if path_stat.st_mode & stat.S_IXUSR else b'100644'
+                with open(full_path, 'rb') as f:
+                    contents = f.read()
+            stream.write(b'M %s inline %s\ndata %d\n' % (mode, _fast_import_quote_path(path), len(contents)))
+            stream.write(contents)
+            stream.write(b'\n')
+        stream.write(b'done\n')
+        stream.close()
+
+    if fast_import.returncode:
+        raise subprocess.CalledProcessError(fast_import.returncode, fast_import_cmd)
+
+    # fast-import does not touch the index, make the work tree look clean
+    subprocess.check_call(('git', 'read-tree', 'HEAD'), cwd=repo_dir)
+
+
 ### FILE utils
 
 def alias(namespace, collection, ptype, plugin, source):
@@ -341,51 +524,17 @@ def write_collection_routing(coll_dir, namespace, collection):
 
 
 def cleanup_targets(checkout_path):
-    dep_targets = {}
-    targets_dir = os.path.join(checkout_path, 'test/integration/targets/')
-    for target in os.listdir(targets_dir):
-        target_dir = os.path.join(targets_dir, target)
-        if not os.path.isdir(target_dir):
-            continue
-        target_relpath = os.path.relpath(target_dir, checkout_path)
-        aliases_file = os.path.join(target_dir, 'aliases')
-        if os.path.basename(target_dir).startswith(('setup_', 'prepare_')):
-            if target_relpath not in dep_targets:
-                dep_targets[target_relpath] = set()
-        elif os.path.exists(aliases_file):
-            for line in read_text_from_file(aliases_file).splitlines():
-                if line.strip() == 'hidden':
-                    if target_relpath not in dep_targets:
-                        dep_targets[target_relpath] = set()
-                    break
-
-    for target in os.listdir(targets_dir):
-        target_dir = os.path.join(targets_dir, target)
-        if not os.path.isdir(target_dir):
-            continue
-        target_relpath = os.path.relpath(target_dir, checkout_path)
-        deps = process_integration_tests_deps(checkout_path, os.path.join(targets_dir, target), log=False)
-        for dep in deps:
-            dep_relpath = os.path.relpath(dep[0], checkout_path)
-            if dep_relpath in dep_targets:
-                dep_targets[dep_relpath].add(target_relpath)
-
-    to_remove = set()
-    while True:
-        added = False
-        for target, used_by in dep_targets.items():
-            if not used_by or used_by.issubset(to_remove):
-                if target not in to_remove:
-                    to_remove.add(target)
-                    added = True
-        if not added:
-            break
+    # NOTE: the migrated targets are gone by now, so the graph is built anew
+    to_remove = {
+        os.path.relpath(target_dir, checkout_path)
+        for target_dir in IntegrationTargetsGraph(checkout_path).get_unused_helpers()
+    }
 
     if to_remove:
         subprocess.check_call(('git', 'rm', '-r', '-f', *to_remove), cwd=checkout_path)
 
 
-def actually_remove(checkout_path):
+def actually_remove(checkout_path, squash=False):
 
     global REMOVE
 
@@ -395,8 +544,57 @@ def actually_remove(checkout_path):
         for collection, paths in coll_map.items()
     }
     paths_counter = Counter(itertools.chain.from_iterable(coll_paths.values()))
-    for coll_fqdn, paths in coll_paths.items():
-        actually_remove_from(coll_fqdn, paths, paths_counter, checkout_path)
+
+    # load sanity/ignore.txt once, the files being removed need to be removed from ignore.txt too
+    sanity_ignore = defaultdict(list)
+    for ignore in read_lines_from_file(os.path.join(checkout_path, SANITY_IGNORE_REL_PATH)):
+        values = ignore.split(' ', 1)
+        sanity_ignore[values[0]].append(values[1])
+
+    # NOTE: the commits are built in a scratch index straight from the
+    # NOTE: trees, the real index and the work tree are only updated once
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_file = os.path.join(tmp_dir, 'index')
+        subprocess.check_call(('git', 'read-tree', 'HEAD'), cwd=checkout_path, env=dict(os.environ, GIT_INDEX_FILE=index_file))
+
+        parent = commit = subprocess.check_output(('git', 'rev-parse', 'HEAD'), cwd=checkout_path, text=True).strip()
+        all_paths_to_delete = set()
+        for coll_fqdn, paths in coll_paths.items():
+            paths_to_delete = actually_remove_from(paths, paths_counter, checkout_path, sanity_ignore)
+            all_paths_to_delete |= paths_to_delete
+            if squash:
+                continue
+
+            commit = commit_index_changes(
+                checkout_path, commit, f'Migrated to {coll_fqdn}',
+                removed_paths=paths_to_delete,
+                new_contents={SANITY_IGNORE_REL_PATH: render_sanity_ignore(sanity_ignore)},
+                index_file=index_file,
+            )
+
+        if squash:
+            commit = commit_index_changes(
+                checkout_path, commit, f'Migrated to {len(coll_paths)} collections',
+                removed_paths=all_paths_to_delete,
+                new_contents={SANITY_IGNORE_REL_PATH: render_sanity_ignore(sanity_ignore)},
+                index_file=index_file,
+            )
+
+    # bring the work tree and the index to the result, then move HEAD;
+    # the removed files may differ from HEAD, e.g. with --convert-symlinks
+    for path in all_paths_to_delete:
+        full_path = os.path.join(checkout_path, path)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(full_path)
+        with contextlib.suppress(OSError):
+            os.removedirs(os.path.dirname(full_path))
+    write_text_into_file(os.path.join(checkout_path, SANITY_IGNORE_REL_PATH), render_sanity_ignore(sanity_ignore))
+    subprocess.run(
+        ('git', 'update-index', '--remove', '-z', '--stdin'),
+        input=''.join(f'{path}\0' for path in sorted(all_paths_to_delete | {SANITY_IGNORE_REL_PATH})),
+        text=True, cwd=checkout_path, check=True,
+    )
+    subprocess.check_call(('git', 'update-ref', 'HEAD', commit, parent), cwd=checkout_path)
 
     # cleanup integration tests targets
     cleanup_targets(checkout_path)
@@ -435,38 +633,61 @@ def actually_remove(checkout_path):
     subprocess.check_call(('git', 'commit', '-m', f'migration final cleanup', '--allow-empty'), cwd=checkout_path)
 
 
-def actually_remove_from(coll_fqdn, paths, paths_counter, checkout_path):
-    # load sanity/ignore.txt, the files being removed below need to be removed from ignore.txt too
-    sanity_ignore = read_lines_from_file(os.path.join(checkout_path, 'test/sanity/ignore.txt'))
-    new_sanity_ignore = defaultdict(list)
-    for ignore in sanity_ignore:
-        values = ignore.split(' ', 1)
-        new_sanity_ignore[values[0]].append(values[1])
+def actually_remove_from(paths, paths_counter, checkout_path, sanity_ignore):
+    """Return the paths to delete for a collection.
 
+    The paths are also dropped from the parsed sanity/ignore.txt.
+    """
     paths_to_delete = set()
-    # actually remove files we marked for removal
     for path in paths:
         actual_devel_path = os.path.relpath(path, checkout_path)
 
         paths_counter[path] -= 1
         if paths_counter[path] == 0:
             paths_to_delete.add(actual_devel_path)
-        new_sanity_ignore.pop(actual_devel_path, None)
+        sanity_ignore.pop(actual_devel_path, None)
 
-    subprocess.check_call(('git', 'rm', '-f', *paths_to_delete), cwd=checkout_path)
+    return paths_to_delete
 
-    # save modified sanity/ignore.txt
-    res = ''
-    for filename, values in new_sanity_ignore.items():
-        for value in values:
-            # value contains '\n' which is preserved from the original file
-            res += '%s %s' % (filename, value)
 
-    write_text_into_file(os.path.join(checkout_path, 'test/sanity/ignore.txt'), res)
-    subprocess.check_call(('git', 'add', 'test/sanity/ignore.txt'), cwd=checkout_path)
+def render_sanity_ignore(sanity_ignore):
+    # values contain '\n' which is preserved from the original file
+    return ''.join(
+        '%s %s' % (filename, value)
+        for filename, values in sanity_ignore.items()
+        for value in values
+    )
 
-    # commit the changes
-    subprocess.check_call(('git', 'commit', '-m', f'Migrated to {coll_fqdn}', '--allow-empty'), cwd=checkout_path)
+
+def commit_index_changes(checkout_path, parent, message, *, removed_paths=(), new_contents=None, index_file=None):
+    """Commit removals and new file contents on top of parent.
+
+    Only the index is updated and the commit is created
+    from its tree directly, the work tree is left as is.
+    Return the new commit hash.
+    """
+    env = None if index_file is None else dict(os.environ, GIT_INDEX_FILE=index_file)
+
+    index_info = [f'0 {NULL_GIT_SHA}\t{path}' for path in sorted(removed_paths)]
+    for path, contents in (new_contents or {}).items():
+        blob = subprocess.check_output(
+            ('git', 'hash-object', '-w', '--stdin'),
+            input=contents, text=True, cwd=checkout_path,
+        ).strip()
+        index_info.append(f'100644 {blob}\t{path}')
+
+    if index_info:
+        subprocess.run(
+            ('git', 'update-index', '--index-info'),
+            input=''.join(f'{line}\n' for line in index_info),
+            text=True, cwd=checkout_path, env=env, check=True,
+        )
+
+    tree = subprocess.check_output(('git', 'write-tree'), text=True, cwd=checkout_path, env=env).strip()
+    return subprocess.check_output(
+        ('git', 'commit-tree', tree, '-p', parent, '-m', message),
+        text=True, cwd=checkout_path,
+    ).strip()
 
 
 def read_yaml_file(path):
@@ -479,9 +700,30 @@ def read_ansible_yaml_file(path):
         return AnsibleLoader(yaml_file.read(), file_name=path).get_single_data()
 
 
+def read_ansible_yaml_file_nodes(path):
+    """Parse the YAML file keeping its source text and node graph.
+
+    Returns the text, the root node and the constructed data along
+    with the mapping of each node to the object constructed from it.
+    """
+    text = read_text_from_file(path)
+    loader = AnsibleLoader(text, file_name=path)
+    try:
+        node = loader.get_single_node()
+        if node is None:
+            return text, None, None, {}
+        # construct_document() rebinds the memo to a new dict when done
+        constructed_objects = loader.constructed_objects
+        contents = loader.construct_document(node)
+    finally:
+        loader.dispose()
+    return text, node, contents, constructed_objects
+
+
 def write_yaml_into_file_as_is(path, data):
     yaml_text = yaml.dump(data, allow_unicode=True, default_flow_style=False, sort_keys=False, width=1024)
     write_text_into_file(path, yaml_text)
+    return yaml_text
 
 
 def write_ansible_yaml_into_file_as_is(path, data):
@@ -489,6 +731,13 @@ def write_ansible_yaml_into_file_as_is(path, data):
     write_text_into_file(path, yaml_text)
 
 
+def git_blob_sha(path):
+    """Compute the git blob SHA of the file contents, like ``git hash-object`` does."""
+    with open(path, 'rb') as f:
+        contents = f.read()
+    return hashlib.sha1(b'blob %d\0' % len(contents) + contents).hexdigest()
+
+
 def read_text_from_file(path):
     with open(path, 'r') as f:
         return f.read()
@@ -500,10 +749,59 @@ def read_lines_from_file(path):
 
 
 def write_text_into_file(path, text):
+    unshare_file(path)
     with open(path, 'w') as f:
         return f.write(text)
 
 
+def unshare_file(path):
+    """Unlink a hardlinked file so that writing it won't change the other links."""
+    with contextlib.suppress(FileNotFoundError):
+        if os.lstat(path).st_nlink > 1:
+            os.unlink(path)
+
+
+def _reflink_file(src, dest):
+    with open(src, 'rb') as src_file, open(dest, 'wb') as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            os.unlink(dest)
+            raise
+
+
+def materialize_file(src, dest, link_mode='copy', copy_function=shutil.copyfile):
+    """Put the src file contents to dest, sharing the data if the link mode allows.
+
+    Reflinks are tried first, hardlinks next and copying
+    with copy_function is the last resort. Note that
+    hardlinks share the mode and timestamps of the src.
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+
+    if link_mode in {'reflink', 'hardlink'}:
+        try:
+            _reflink_file(src, dest)
+        except OSError as err:
+            logger.debug('Could not reflink %s to %s: %s', src, dest, err)
+        else:
+            copy_metadata = LINK_COPY_METADATA_FUNCS[copy_function]
+            if copy_metadata is not None:
+                copy_metadata(src, dest)
+            return
+
+    if link_mode == 'hardlink':
+        try:
+            os.link(src, dest)
+        except OSError as err:
+            logger.debug('Could not hardlink %s to %s: %s', src, dest, err)
+        else:
+            return
+
+    copy_function(src, dest)
+
+
 @contextlib.contextmanager
 def working_directory(target_dir):
     """Temporary change dir to the target and change back on exit."""
@@ -528,8 +826,111 @@ def load_spec_file(spec_file):
     return spec
 
 
+def _glob_segment_to_re(segment):
+    # like glob, wildcards don't match the leading dot of hidden files
+    chunks = [] if segment.startswith('.') else [r'(?!\.)']
+    i = 0
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == '*':
+            chunks.append('[^/]*')
+        elif char == '?':
+            chunks.append('[^/]')
+        elif char == '[':
+            class_start = i + 1 if segment[i:i + 1] == '!' else i
+            class_end = segment.find(']', class_start + 1 if segment[class_start:class_start + 1] == ']' else class_start)
+            if class_end == -1:
+                chunks.append(re.escape(char))
+                continue
+            class_body = segment[i:class_end].replace('\\', '\\\\')
+            if class_body.startswith('!'):
+                class_body = '^' + class_body[1:]
+            elif class_body.startswith('^'):
+                # a literal caret for fnmatch, not a negation
+                class_body = '\\' + class_body
+            chunks.append('[%s]' % class_body)
+            i = class_end + 1
+        else:
+            chunks.append(re.escape(char))
+    return ''.join(chunks)
+
+
+def compile_path_glob(pattern):
+    """Compile a glob pattern into a regex matching "/"-separated paths.
+
+    ``**`` as a whole path segment matches any number of directories,
+    except for the hidden ones, same as ``glob(recursive=True)``.
+    """
+    segments = pattern.split('/')
+    regex_chunks = []
+    for idx, segment in enumerate(segments):
+        is_last = idx == len(segments) - 1
+        if segment == '**':
+            regex_chunks.append(r'(?:(?!\.)[^/]+(?:/|\Z))*' if is_last else r'(?:(?!\.)[^/]+/)*')
+        else:
+            regex_chunks.append(_glob_segment_to_re(segment) + ('' if is_last else '/'))
+    return re.compile(''.join(regex_chunks) + r'\Z')
+
+
+class TrackedPaths:
+    """In-memory view of the files tracked in the checkout."""
+
+    def __init__(self, files):
+        self.files = sorted(files)
+        self.file_set = frozenset(self.files)
+        self.children = defaultdict(set)
+        for tracked_file in self.files:
+            parent = ''
+            for part in tracked_file.split('/'):
+                self.children[parent].add(part)
+                parent = f'{parent}/{part}' if parent else part
+        self.dirs = set(self.children) - {''}
+
+    def _under(self, prefix):
+        first = bisect.bisect_left(self.files, prefix)
+        last = bisect.bisect_left(self.files, prefix[:-1] + chr(ord(prefix[-1]) + 1)) if prefix else len(self.files)
+        return self.files[first:last]
+
+    def glob(self, pattern):
+        """Return the tracked files and whether any tracked path matches."""
+        segments = pattern.split('/')
+        literal_segments = list(itertools.takewhile(lambda seg: not GLOB_MAGIC_RE.search(seg), segments[:-1]))
+        prefix = ''.join(f'{seg}/' for seg in literal_segments)
+        pattern_re = compile_path_glob(pattern)
+        matched_files = [path for path in self._under(prefix) if pattern_re.match(path)]
+        return matched_files, bool(matched_files) or any(pattern_re.match(path) for path in self.dirs if path.startswith(prefix))
+
+    def has_dir(self, path):
+        return path in self.dirs
+
+    def has_file(self, path):
+        return path in self.file_set
+
+    def listdir(self, path):
+        return sorted(self.children.get(path, ()))
+
+    def files_under(self, path):
+        return self._under(f'{path}/')
+
+
+def is_visible_to_glob(relative_path):
+    """Tell if glob's ``**`` or ``.*`` at the top level would yield the path."""
+    *dir_parts, name = relative_path.split('/')
+    return not any(part.startswith('.') for part in dir_parts) and (not dir_parts or not name.startswith('.'))
+
+
+@functools.lru_cache()
+def get_unit_tests_index(checkout_path):
+    """Return the in-memory view of the tracked unit tests files."""
+    unit_tests_prefix = os.path.join('test', 'units', '')
+    return TrackedPaths(f for f in ALL_THE_FILES if f.startswith(unit_tests_prefix))
+
+
 def resolve_spec(spec, checkoutdir):
     # TODO: add negation? entry: x/* \n entry: !x/base.py
+    invalidate_plugin_index()
+    tracked_paths = TrackedPaths(ALL_THE_FILES)
     files_to_collections = defaultdict(list)
     for ns in spec.keys():
         for coll in spec[ns].keys():
@@ -542,51 +943,42 @@ def resolve_spec(spec, checkoutdir):
 
                 if ptype not in VALID_SPEC_ENTRIES:
                     raise Exception('Invalid plugin type: %s, expected one of %s' % (ptype, VALID_SPEC_ENTRIES))
-                plugin_base = os.path.join(checkoutdir, PLUGIN_EXCEPTION_PATHS.get(ptype, os.path.join('lib', 'ansible', 'plugins', ptype)))
-                replace_base = '%s/' % plugin_base
+                relative_plugin_base = PLUGIN_EXCEPTION_PATHS.get(ptype, os.path.join('lib', 'ansible', 'plugins', ptype))
+                plugin_base = os.path.join(checkoutdir, relative_plugin_base)
+                replace_base = '%s/' % relative_plugin_base
                 new_ptype = []
+                to_verify = []
                 for entry in spec[ns][coll][ptype]:
-                    if r'*' in entry or r'?' in entry:
-                        files = glob.glob(os.path.join(plugin_base, entry))
-                        if not files:
+                    if GLOB_MAGIC_RE.search(entry):
+                        files, matched = tracked_paths.glob(os.path.join(relative_plugin_base, entry))
+                        if not matched:
                             raise Exception('No matches for plugin type: %s, entry: %s. Searched in %s.' % (ptype, entry, os.path.join(plugin_base, entry)))
 
                         for fname in files:
-                            if ptype not in NOT_PLUGINS and fname.endswith('__init__.py') or not os.path.isfile(fname):
+                            if ptype not in NOT_PLUGINS and fname.endswith('__init__.py'):
                                 continue
-                            fname = fname.replace(replace_base, '')
-                            new_ptype.append(fname)
+                            new_ptype.append(fname[len(replace_base):])
                     else:
                         new_ptype.append(entry)
 
+                        relative_path = os.path.normpath(os.path.join(relative_plugin_base, entry))
+                        if not tracked_paths.has_dir(relative_path):
+                            to_verify.append(relative_path)
+
                 spec[ns][coll][ptype] = new_ptype
 
                 # NOTE now that spec for plugins of ptype has been finalized, we can iterate again and add files for the dupe check
                 for entry in spec[ns][coll][ptype]:
                     files_to_collections[os.path.join(plugin_base, entry)].append(coll)
 
-                def dir_to_path(path):
-                    if not (os.path.isdir(path) and os.path.exists(path)):
-                        return path
-                    return next(
-                        subpath
-                        for subpath in glob.glob(os.path.join(path, '**'), recursive=True)
-                        if not os.path.isdir(subpath)
-                    )
                 logger.info(
                     'Verifying that all %s '
                     'that are scheduled for migration '
                     'to %s.%s exist...',
                     ptype, ns, coll,
                 )
-                assert_migrating_git_tracked_resources(
-                    os.path.relpath(dir_to_path(p_abs), checkoutdir)
-                    for p in spec[ns][coll][ptype]
-                    for p_abs in (
-                        glob.glob(os.path.join(plugin_base, p))
-                        or [os.path.join(plugin_base, p)]
-                    )
-                )
+                # NOTE: glob matches come from the tracked files already
+                assert_migrating_git_tracked_resources(to_verify)
                 logger.info(
                     'All %s entries for %s.%s '
                     'are valid',
@@ -599,16 +991,71 @@ def resolve_spec(spec, checkoutdir):
         logger.error(err_msg)
         raise RuntimeError(err_msg)
 
+    build_plugin_index(spec)
+
 
 ### GET_PLUGINS UTILS
 
-def get_plugin_collection(plugin_name, plugin_type, spec):
+def invalidate_plugin_index():
+    """Drop the plugin lookup index, it is rebuilt on the next lookup."""
+    global PLUGIN_INDEX
+    PLUGIN_INDEX = {}
+    JINJA_PLUGIN_MAPS.clear()
+
+
+def build_plugin_index(spec):
+    """Precompute plugin to collection lookups for the given spec.
+
+    ``by_path`` maps ``(plugin_type, plugin_path_wo_ext)`` to the first
+    ``(namespace, collection)`` it is assigned to in the spec order,
+    ``by_name`` maps ``(plugin_type, plugin_basename)`` to the distinct
+    ``(namespace, collection)`` pairs containing it and ``by_type`` maps
+    ``plugin_type`` to ``(namespace, collection, plugin_basename)``
+    triples, also in the spec order.
+    """
+    global PLUGIN_INDEX
+
+    by_path = {}
+    by_name = defaultdict(list)
+    by_type = defaultdict(list)
     for ns in spec.keys():
         for collection in spec[ns].keys():
-            if spec[ns][collection]: # avoid empty collections
-                plugins = spec[ns][collection].get(plugin_type, [])
-                if plugin_name + '.py' in plugins:
-                    return ns, collection
+            if not spec[ns][collection]: # avoid empty collections
+                continue
+            for plugin_type, plugins in spec[ns][collection].items():
+                if plugin_type == '_options':
+                    continue
+                for plugin in plugins or ():
+                    if plugin.endswith('.py'):
+                        by_path.setdefault((plugin_type, plugin[:-3]), (ns, collection))
+                    plugin_name = plugin.rsplit('/')[-1][:-3]
+                    name_collections = by_name[(plugin_type, plugin_name)]
+                    # same named plugins from different subdirs count once per collection
+                    if (ns, collection) not in name_collections:
+                        name_collections.append((ns, collection))
+                    by_type[plugin_type].append((ns, collection, plugin_name))
+
+    PLUGIN_INDEX = {
+        'spec_id': id(spec),
+        'by_path': by_path,
+        'by_name': dict(by_name),
+        'by_type': dict(by_type),
+    }
+    return PLUGIN_INDEX
+
+
+def get_plugin_index(spec):
+    """Return the plugin lookup index, (re)building it if it is stale."""
+    if PLUGIN_INDEX.get('spec_id') != id(spec):
+        return build_plugin_index(spec)
+    return PLUGIN_INDEX
+
+
+def get_plugin_collection(plugin_name, plugin_type, spec):
+    try:
+        return get_plugin_index(spec)['by_path'][(plugin_type, plugin_name)]
+    except KeyError:
+        pass
 
     # keep info
     plugin_name = plugin_name.replace('/', '.')
@@ -618,6 +1065,59 @@ def get_plugin_collection(plugin_name, plugin_type, spec):
     raise LookupError('Could not find "%s" named "%s" in any collection in the spec' % (plugin_type, plugin_name))
 
 
+def get_plugin_collections_by_name(plugin_name, plugin_type, spec):
+    """Return rewritable collections having a plugin with the given basename."""
+    return [
+        (ns, coll)
+        for ns, coll in get_plugin_index(spec)['by_name'].get((plugin_type, plugin_name), [])
+        if coll not in COLLECTION_SKIP_REWRITE
+    ]
+
+
+def get_rewritable_plugins_of_type(plugin_type, spec):
+    """Return ``(namespace, collection, plugin_name)`` for rewritable plugins of the given type."""
+    return [
+        (ns, coll, plugin_name)
+        for ns, coll, plugin_name in get_plugin_index(spec)['by_type'].get(plugin_type, [])
+        if coll not in COLLECTION_SKIP_REWRITE
+    ]
+
+
+def get_sh_plugin_rewrite_matcher(spec):
+    """Return the regex matching the plugin references in shell scripts.
+
+    The match group named after the plugin type holds the plugin
+    name, the second value maps it to ``(namespace, collection)``.
+    Both are built once per spec.
+    """
+    plugin_index = get_plugin_index(spec)
+    if 'sh_rewrite' in plugin_index:
+        return plugin_index['sh_rewrite']
+
+    keys_by_type = defaultdict(list)
+    for key, plugin_type in SH_KEY_MAP.items():
+        keys_by_type[plugin_type].append(key)
+
+    alternatives = []
+    plugin_fqcns = {}
+    for plugin_type, keys in keys_by_type.items():
+        plugin_colls = plugin_fqcns[plugin_type] = {}
+        for ns, coll, plugin_name in get_rewritable_plugins_of_type(plugin_type, spec):
+            # FIXME list
+            plugin_colls.setdefault(plugin_name, (ns, coll))
+        if not plugin_colls:
+            continue
+        alternatives.append('(?:%s)[= ](?P<%s>%s)(?!\\w)' % (
+            '|'.join(map(re.escape, sorted(keys, key=len, reverse=True))),
+            plugin_type,
+            '|'.join(map(re.escape, sorted(plugin_colls, key=len, reverse=True))),
+        ))
+
+    sh_rewrite_re = re.compile('|'.join(alternatives)) if alternatives else None
+    plugin_index['sh_rewrite'] = sh_rewrite_re, plugin_fqcns
+    return plugin_index['sh_rewrite']
+
+
 def get_plugins_from_collection(ns, collection, plugin_type, spec):
     assert ns in spec
     assert collection in spec[ns]
@@ -635,6 +1135,142 @@ def get_rewritable_collections(namespace, spec):
     return (collection for collection in spec[namespace].keys() if collection not in COLLECTION_SKIP_REWRITE)
 
 
+### REWRITE CACHE
+
+def record_rewrite_side_effect(func_name, *func_args):
+    """Remember a global state update for replaying it on a cache hit."""
+    for side_effects in REWRITE_SIDE_EFFECTS:
+        side_effects.append((func_name, func_args))
+
+
+def replay_rewrite_side_effects(side_effects):
+    """Re-apply global state updates recorded for a cached rewrite."""
+    for func_name, func_args in side_effects:
+        assert func_name in REWRITE_SIDE_EFFECT_FUNCS
+        globals()[func_name](*func_args)
+
+
+@functools.lru_cache()
+def get_migrator_digest():
+    """Return the hash of this script and its rewrite helper modules.
+
+    Rewrite results depend on the code of all of them.
+    """
+    return hashlib.sha256(' '.join(
+        git_blob_sha(sys.modules[module_name].__file__)
+        for module_name in (__name__,) + REWRITE_HELPER_MODULES
+    ).encode()).hexdigest()
+
+
+def get_spec_digest(spec):
+    """Return the hash of the spec parts that affect the rewrites."""
+    plugin_index = get_plugin_index(spec)
+    if 'digest' not in plugin_index:
+        plugin_index['digest'] = hashlib.sha256(repr(sorted(
+            (ptype, ns, coll, plugin_name)
+            for ptype, plugins in plugin_index['by_type'].items()
+            for ns, coll, plugin_name in plugins
+        )).encode() + repr(sorted(plugin_index['by_path'].items())).encode()).hexdigest()
+    return plugin_index['digest']
+
+
+def get_rewrite_cache_path(rewrite_func_name, call_args, extra_key_funcs):
+    """Compute the content-addressed cache entry path for a rewrite call."""
+    cli_args = call_args['args']
+    options = call_args.get('options') or {}
+    key_parts = [
+        get_migrator_digest(),
+        rewrite_func_name,
+        git_blob_sha(call_args['src']),
+        get_spec_digest(call_args['spec']),
+        call_args['namespace'],
+        call_args['collection'],
+        call_args['dest'],
+        call_args.get('plugin_type'),
+        cli_args.preserve_module_subdirs,
+        options.get('flatmap'),
+        cli_args.fail_on_core_rewrite,
+        cli_args.rewrite_engine,
+        cli_args.yaml_rewrite_mode,
+    ]
+    key_parts.extend(extra_key_func(call_args) for extra_key_func in extra_key_funcs)
+
+    cache_key = hashlib.sha256(repr(key_parts).encode()).hexdigest()
+    return os.path.join(cli_args.vardir, 'rewrite-cache', cache_key[:2], f'{cache_key}.pickle')
+
+
+def cached_rewrite(*extra_key_funcs):
+    """Serve rewritten files from an on-disk content-addressed cache.
+
+    The cache key is made of the source blob SHA, the spec digest and
+    the CLI options affecting the rewrite. Each entry holds the rewritten
+    file, the return value and the global state updates to replay.
+    """
+    def decorator(rewrite_func):
+        rewrite_func_sig = inspect.signature(rewrite_func)
+
+        @functools.wraps(rewrite_func)
+        def rewrite_func_wrapper(*func_args, **func_kwargs):
+            call_args = rewrite_func_sig.bind(*func_args, **func_kwargs)
+            call_args.apply_defaults()
+            call_args = call_args.arguments
+            with run_timer.phase(rewrite_func.__name__, path=call_args['src']):
+                if not call_args['args'].rewrite_cache:
+                    return rewrite_func(*func_args, **func_kwargs)
+
+                dest = call_args['dest']
+                cache_path = get_rewrite_cache_path(rewrite_func.__name__, call_args, extra_key_funcs)
+                try:
+                    with open(cache_path, 'rb') as cache_file:
+                        cache_entry = pickle.load(cache_file)
+                except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                    pass
+                else:
+                    logger.debug('Using cached rewrite of %s', dest)
+                    run_timer.count('rewrite_cache_hits')
+                    if cache_entry['contents'] is None:
+                        # unchanged by the rewrite
+                        materialize_file(call_args['src'], dest, call_args['args'].link_mode)
+                        if stat.S_IMODE(os.stat(dest).st_mode) != cache_entry['mode']:
+                            # the mode of a shared inode mustn't be changed
+                            materialize_file(call_args['src'], dest)
+                    else:
+                        unshare_file(dest)
+                        with open(dest, 'wb') as dest_file:
+                            dest_file.write(cache_entry['contents'])
+                    os.chmod(dest, cache_entry['mode'])
+                    replay_rewrite_side_effects(cache_entry['side_effects'])
+                    return cache_entry['result']
+
+                side_effects = []
+                REWRITE_SIDE_EFFECTS.append(side_effects)
+                try:
+                    result = rewrite_func(*func_args, **func_kwargs)
+                finally:
+                    REWRITE_SIDE_EFFECTS.remove(side_effects)
+
+                with open(dest, 'rb') as dest_file, open(call_args['src'], 'rb') as src_file:
+                    dest_contents = dest_file.read()
+                    cache_entry = {
+                        # NOTE: None is for the files kept as is, those are linked on hits
+                        'contents': None if dest_contents == src_file.read() else dest_contents,
+                        'mode': stat.S_IMODE(os.fstat(dest_file.fileno()).st_mode),
+                        'result': result,
+                        'side_effects': side_effects,
+                    }
+
+                # parallel workers may write the same entry, make it atomic
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                tmp_cache_path = f'{cache_path}.{os.getpid()}.tmp'
+                with open(tmp_cache_path, 'wb') as cache_file:
+                    pickle.dump(cache_entry, cache_file)
+                os.replace(tmp_cache_path, cache_path)
+
+                return result
+        return rewrite_func_wrapper
+    return decorator
+
+
 ### REWRITE FUNCTIONS
 
 def rewrite_class_property(mod_fst, collection, namespace, filename):
@@ -659,119 +1295,230 @@ def rewrite_class_property(mod_fst, collection, namespace, filename):
             add_manual_check(property_name, val.value, filename)
 
 
-def normalize_implicit_relative_imports_in_unit_tests(mod_fst, file_path):
-    """Locate implicit imports and prepend them with dot."""
+def rewrite_class_property_in_source(splicer, collection, namespace, filename):
+    """Offset-based counterpart of :func:`rewrite_class_property`."""
+    if all(f'plugins/{p}' not in filename for p in REWRITE_CLASS_PROPERTY_PLUGINS):
+        return
+
+    # validate everything first so that falling back
+    # to RedBaron doesn't duplicate the manual checks
+    replacements = []
+    manual_checks = []
+    for class_name, property_name in REWRITE_CLASS_PROPERTY_MAP.items():
+        class_node = next(
+            (n for n in splicer.nodes_of_type(ast.ClassDef) if n.name == class_name),
+            None,
+        )
+        if class_node is None:
+            continue
+
+        # RedBaron picks the first name node matching the property in the class
+        property_nodes = [
+            n for n in ast.walk(class_node)
+            if (isinstance(n, ast.Name) and n.id == property_name)
+            or (isinstance(n, ast.Attribute) and n.attr == property_name)
+            or (isinstance(n, (ast.arg, ast.keyword)) and n.arg == property_name)
+        ]
+        if not property_nodes:
+            continue
+        property_node = min(property_nodes, key=lambda n: (getattr(n, 'lineno', 0), getattr(n, 'col_offset', -1)))
+        assignment = next(
+            (
+                n for n in ast.walk(class_node)
+                if isinstance(n, ast.Assign) and n.targets == [property_node]
+            ),
+            None,
+        )
+        if assignment is None:
+            raise UnsupportedSourceLayout(f'{class_name}.{property_name} is not a plain assignment')
+
+        try:
+            property_value = ast.literal_eval(assignment.value)
+        except ValueError:
+            if not isinstance(assignment.value, ast.Name):
+                raise UnsupportedSourceLayout(f'{class_name}.{property_name} is not a literal or a name')
+            # so this might be something like:
+            # transport = CONNECTION_TRANSPORT
+            manual_checks.append((property_name, assignment.value.id, filename))
+            continue
+
+        value_tokens = splicer.assigned_value_tokens(assignment)
+        replacements.append((
+            value_tokens[0].start, value_tokens[-1].end,
+            "'%s'" % get_plugin_fqcn(namespace, collection, property_value),
+        ))
+
+    for start, end, new_value in replacements:
+        splicer.replace(start, end, new_value)
+    for manual_check_args in manual_checks:
+        add_manual_check(*manual_check_args)
+
+
+def is_implicit_relative_import(imp_src_parts, file_path):
+    """Check whether a ``from`` import refers to a sibling module."""
     cur_pkg_dir = os.path.dirname(file_path)
     make_pkg_subpath = functools.partial(os.path.join, cur_pkg_dir)
+
+    *pkg_path_parts, pkg_or_mod = imp_src_parts
+    if ((pkg_path_parts and not pkg_path_parts[0]) or (not pkg_path_parts and pkg_or_mod == '__future__')):  # import is already absolute
+        return False
+
+    relative_mod_path = make_pkg_subpath(*pkg_path_parts, f'{pkg_or_mod}.py')
+    if relative_mod_path == file_path:  # self-import? nope! def other mod
+        return False
+
+    relative_pkg_init_path = make_pkg_subpath(*pkg_path_parts, pkg_or_mod, '__init__.py')
+
+    possible_relative_targets = {relative_mod_path, relative_pkg_init_path}
+    return any(os.path.exists(p) for p in possible_relative_targets)
+
+
+def normalize_implicit_relative_imports_in_unit_tests(mod_fst, file_path):
+    """Locate implicit imports and prepend them with dot."""
     for imp in mod_fst.find_all(('from_import', )):
         if not imp.value:  # from . import something
             continue
 
-        *pkg_path_parts, pkg_or_mod = tuple(t.value for t in imp.value)
-        if ((pkg_path_parts and not pkg_path_parts[0]) or (not pkg_path_parts and pkg_or_mod == '__future__')):  # import is already absolute
+        if imp.value.dumps().startswith('.'):  # from .module import something, the dots are not among the names
             continue
 
-        relative_mod_path = make_pkg_subpath(*pkg_path_parts, f'{pkg_or_mod}.py')
-        if relative_mod_path == file_path:  # self-import? nope! def other mod
+        if not is_implicit_relative_import(tuple(t.value for t in imp.value), file_path):
             continue
 
-        relative_pkg_init_path = make_pkg_subpath(*pkg_path_parts, pkg_or_mod, '__init__.py')
+        # turn implicit relative import into an explicit absolute import
+        # that is relative to the current module
+        imp.value = f'.{imp.value.dumps()!s}'
 
-        possible_relative_targets = {relative_mod_path, relative_pkg_init_path}
-        relative_imp_target_exists = any(os.path.exists(p) for p in possible_relative_targets)
 
-        if not relative_imp_target_exists:
+def normalize_implicit_relative_imports_in_source(splicer, file_path):
+    """Offset-based counterpart of :func:`normalize_implicit_relative_imports_in_unit_tests`."""
+    for imp in splicer.imports():
+        if imp.type != 'from_import' or imp.level or imp.name_start is None:
             continue
 
-        # turn implicit relative import into an explicit absolute import
-        # that is relative to the current module
-        imp.value = f'.{imp.value.dumps()!s}'
+        imp_src = splicer.text_of(imp.name_start, imp.name_end)
+        if not is_implicit_relative_import(tuple(p.strip() for p in imp_src.split('.')), file_path):
+            continue
 
+        splicer.replace(imp.name_start, imp.name_end, f'.{imp_src!s}')
 
-def rewrite_unit_tests_patch(mod_fst, collection, spec, namespace, args, options):
+
+def build_import_map(namespace, collection):
+    """Return the map of import path prefixes to their collection paths."""
     plugins_path = ('ansible_collections', namespace, collection, 'plugins')
     tests_path = ('ansible_collections', namespace, collection, 'tests')
     unit_tests_path = tests_path + ('unit', )
-    import_map = {
+    return {
         ('ansible', 'modules'): plugins_path + ('modules', ),
         ('ansible', 'module_utils'): plugins_path + ('module_utils', ),
         ('ansible', 'plugins'): plugins_path,
         ('units', ): unit_tests_path,
     }
 
-    patches = (
-        mod_fst('string',
-                lambda x:
-                    'ansible.modules' in x.dumps() or
-                    'ansible.module_utils' in x.dumps() or
-                    'ansible.plugins' in x.dumps() or
-                    'units' in x.dumps()
-        )
-    )
 
-    deps = []
-    for el in patches:
-        val = el.to_python().split('.')
+def rewrite_unit_tests_patch_value(str_val, collection, spec, namespace, args, options):
+    """Rewrite a dotted path in a string used for patching in unit tests.
 
-        for old, new in import_map.items():
-            token_length = len(old)
-            if tuple(val[:token_length]) != old:
-                continue
+    Return the new dotted path, or ``None`` if it stays as is,
+    and the collection dependencies.
+    """
+    import_map = build_import_map(namespace, collection)
 
-            if val[0] == 'units':
-                val[:token_length] = new
-                el.value = "'%s'" % '.'.join(val)
-                continue
-            elif val[1] in ('modules', 'module_utils'):
-                plugin_type = val[1]
+    deps = []
+    new_str_val = None
+    val = str_val.split('.')
 
-                # 'ansible.modules.storage.netapp.na_ontap_nvme.NetAppONTAPNVMe.create_nvme'
-                # look for module name
-                for i in (len(val), -1, -2):
-                    plugin_name = '/'.join(val[2:i])
-                    try:
-                        found_ns, found_coll = get_plugin_collection(plugin_name, plugin_type, spec)
-                        break
-                    except LookupError:
-                        continue
-                else:
-                    continue
-            elif val[1] == 'plugins':
-                # 'ansible.plugins.lookup.manifold.open_url'
-                try:
-                    plugin_type = val[2]
-                    plugin_name = val[3]
-                except IndexError:
-                    # Not enough information to search for the plugin, safe to assume it's not for the rewrite
-                    # e.g. 'ansible.plugins.inventory'
-                    continue
+    for old, new in import_map.items():
+        token_length = len(old)
+        if tuple(val[:token_length]) != old:
+            continue
+
+        if val[0] == 'units':
+            val[:token_length] = new
+            new_str_val = '.'.join(val)
+            continue
+        elif val[1] in ('modules', 'module_utils'):
+            plugin_type = val[1]
 
+            # 'ansible.modules.storage.netapp.na_ontap_nvme.NetAppONTAPNVMe.create_nvme'
+            # look for module name
+            for i in (len(val), -1, -2):
+                plugin_name = '/'.join(val[2:i])
                 try:
                     found_ns, found_coll = get_plugin_collection(plugin_name, plugin_type, spec)
+                    break
                 except LookupError:
                     continue
             else:
                 continue
+        elif val[1] == 'plugins':
+            # 'ansible.plugins.lookup.manifold.open_url'
+            try:
+                plugin_type = val[2]
+                plugin_name = val[3]
+            except IndexError:
+                # Not enough information to search for the plugin, safe to assume it's not for the rewrite
+                # e.g. 'ansible.plugins.inventory'
+                continue
 
-            if found_coll in COLLECTION_SKIP_REWRITE:
+            try:
+                found_ns, found_coll = get_plugin_collection(plugin_name, plugin_type, spec)
+            except LookupError:
                 continue
+        else:
+            continue
 
-            if args.fail_on_core_rewrite:
-                raise RuntimeError('Rewriting to %s' % '.'.join(val))
+        if found_coll in COLLECTION_SKIP_REWRITE:
+            continue
 
-            val[:token_length] = new
+        if args.fail_on_core_rewrite:
+            raise RuntimeError('Rewriting to %s' % '.'.join(val))
+
+        val[:token_length] = new
+
+        if plugin_type == 'modules' and not (args.preserve_module_subdirs or options.get('flatmap')):
+            plugin_subdirs_len = len(plugin_name.split('/')[:-1])
+            new_len = len(new)
+            del val[new_len:new_len+plugin_subdirs_len]
 
-            if plugin_type == 'modules' and not (args.preserve_module_subdirs or options.get('flatmap')):
-                plugin_subdirs_len = len(plugin_name.split('/')[:-1])
-                new_len = len(new)
-                del val[new_len:new_len+plugin_subdirs_len]
+        if (found_ns, found_coll) != (namespace, collection):
+            val[1] = found_ns
+            val[2] = found_coll
+            deps.append((found_ns, found_coll))
 
-            if (found_ns, found_coll) != (namespace, collection):
-                val[1] = found_ns
-                val[2] = found_coll
-                deps.append((found_ns, found_coll))
+        new_str_val = '.'.join(val)
 
-            el.value = "'%s'" % '.'.join(val)
+    return new_str_val, deps
+
+
+def rewrite_unit_tests_patch(mod_fst, collection, spec, namespace, args, options):
+    patches = (
+        mod_fst('string',
+                lambda x: any(needle in x.dumps() for needle in UNIT_TESTS_PATCH_NEEDLES)
+        )
+    )
+
+    deps = []
+    for el in patches:
+        new_str_val, patch_deps = rewrite_unit_tests_patch_value(el.to_python(), collection, spec, namespace, args, options)
+        deps += patch_deps
+        if new_str_val is not None:
+            el.value = "'%s'" % new_str_val
+
+    return deps
+
+
+def rewrite_unit_tests_patch_in_source(splicer, collection, spec, namespace, args, options):
+    """Offset-based counterpart of :func:`rewrite_unit_tests_patch`."""
+    deps = []
+    for tok in splicer.string_literals():
+        if not any(needle in tok.string for needle in UNIT_TESTS_PATCH_NEEDLES):
+            continue
+
+        new_str_val, patch_deps = rewrite_unit_tests_patch_value(ast.literal_eval(tok.string), collection, spec, namespace, args, options)
+        deps += patch_deps
+        if new_str_val is not None:
+            splicer.replace(tok.start, tok.end, "'%s'" % new_str_val)
 
     return deps
 
@@ -816,20 +1563,14 @@ def rewrite_docs_fragments(docs, collection, spec, namespace, args):
     return deps, old_fragments, new_fragments
 
 
-def rewrite_plugin_documentation(mod_fst, collection, spec, namespace, args):
-    try:
-        doc_val = (
-            mod_fst.
-            find_all('assignment').
-            find('name', value='DOCUMENTATION').
-            parent.
-            value
-        )
-    except AttributeError:
-        raise LookupError('No DOCUMENTATION found')
+def rewrite_documentation_text(doc_text, collection, spec, namespace, args):
+    """Rewrite doc fragments, seealso and version_added in plugin docs.
 
-    docs_parsed_dict = yaml.safe_load(doc_val.to_python().strip('\n'))
-    docs_parsed_list = doc_val.to_python().split('\n')
+    Return the collection dependencies and the new docs text,
+    or ``None`` if it is unchanged.
+    """
+    docs_parsed_dict = yaml.safe_load(doc_text.strip('\n'))
+    docs_parsed_list = doc_text.split('\n')
 
     # docs fragments prep
     deps, old_fragments, new_fragments = rewrite_docs_fragments(docs_parsed_dict, collection, spec, namespace, args)
@@ -852,21 +1593,17 @@ def rewrite_plugin_documentation(mod_fst, collection, spec, namespace, args):
         if not module_name:
             continue
         try:
-            for ns in spec.keys():
-                for coll in get_rewritable_collections(ns, spec):
-                    if collection == coll:
-                        # https://github.com/ansible-community/collection_migration/issues/156
-                        continue
-
-                    if module_name not in get_plugins_from_collection(ns, coll, 'modules', spec):
-                        continue
+            for ns, coll in get_plugin_collections_by_name(module_name, 'modules', spec):
+                if collection == coll:
+                    # https://github.com/ansible-community/collection_migration/issues/156
+                    continue
 
-                    new_module_name = get_plugin_fqcn(ns, coll, module_name)
-                    msg = 'Rewriting to %s' % new_module_name
-                    if args.fail_on_core_rewrite:
-                        raise RuntimeError(msg)
+                new_module_name = get_plugin_fqcn(ns, coll, module_name)
+                msg = 'Rewriting to %s' % new_module_name
+                if args.fail_on_core_rewrite:
+                    raise RuntimeError(msg)
 
-                    seealso_rewrite_map[module_name] = new_module_name
+                seealso_rewrite_map[module_name] = new_module_name
         except LookupError:
             continue
 
@@ -926,6 +1663,25 @@ def rewrite_plugin_documentation(mod_fst, collection, spec, namespace, args):
         new_docs.append(line)
 
     if not changed:
+        return [], None
+
+    return deps, '\n'.join(new_docs)
+
+
+def rewrite_plugin_documentation(mod_fst, collection, spec, namespace, args):
+    try:
+        doc_val = (
+            mod_fst.
+            find_all('assignment').
+            find('name', value='DOCUMENTATION').
+            parent.
+            value
+        )
+    except AttributeError:
+        raise LookupError('No DOCUMENTATION found')
+
+    deps, new_docs = rewrite_documentation_text(doc_val.to_python(), collection, spec, namespace, args)
+    if new_docs is None:
         return []
 
     doc_str_tmpl = RAW_STR_TMPL if doc_val.type == 'raw_string' else STR_TMPL
@@ -946,44 +1702,164 @@ def rewrite_plugin_documentation(mod_fst, collection, spec, namespace, args):
     # ```
     # DOCUMENTATION = '''some string value'''
     # ```
-    doc_val.value = doc_str_tmpl.format(str_val='\n'.join(new_docs))
+    doc_val.value = doc_str_tmpl.format(str_val=new_docs)
+
+    return deps
+
+
+def rewrite_plugin_documentation_in_source(splicer, collection, spec, namespace, args):
+    """Offset-based counterpart of :func:`rewrite_plugin_documentation`."""
+    doc_assignment = next(
+        (
+            n for n in splicer.nodes_of_type((ast.Assign, ast.AugAssign))
+            if any(isinstance(sn, ast.Name) and sn.id == 'DOCUMENTATION' for sn in ast.walk(n))
+        ),
+        None,
+    )
+    if doc_assignment is None:
+        raise LookupError('No DOCUMENTATION found')
+
+    is_plain_doc_assignment = (
+        isinstance(doc_assignment, ast.Assign)
+        and len(doc_assignment.targets) == 1
+        and isinstance(doc_assignment.targets[0], ast.Name)
+        and doc_assignment.targets[0].id == 'DOCUMENTATION'
+        and _ast_str_value(doc_assignment.value) is not None
+    )
+    if not is_plain_doc_assignment:
+        raise UnsupportedSourceLayout('DOCUMENTATION is not a plain string assignment')
+
+    doc_tokens = splicer.assigned_value_tokens(doc_assignment)
+    if any(t.type != tokenize.STRING for t in doc_tokens):
+        raise UnsupportedSourceLayout('DOCUMENTATION is not a plain string assignment')
+
+    deps, new_docs = rewrite_documentation_text(_ast_str_value(doc_assignment.value), collection, spec, namespace, args)
+    if new_docs is None:
+        return []
+
+    # RedBaron only treats single r'' literals as raw strings, see rewrite_plugin_documentation
+    doc_str_prefix = doc_tokens[0].string[:doc_tokens[0].string.index(doc_tokens[0].string[-1])]
+    is_raw_string = len(doc_tokens) == 1 and doc_str_prefix.lower() == 'r'
+    doc_str_tmpl = RAW_STR_TMPL if is_raw_string else STR_TMPL
+    splicer.replace(doc_tokens[0].start, doc_tokens[-1].end, doc_str_tmpl.format(str_val=new_docs))
 
     return deps
 
 
 def rewrite_imports(mod_fst, collection, spec, namespace, args, options):
     """Rewrite imports map."""
-    plugins_path = ('ansible_collections', namespace, collection, 'plugins')
-    tests_path = ('ansible_collections', namespace, collection, 'tests')
-    unit_tests_path = tests_path + ('unit', )
-    import_map = {
-        ('ansible', 'modules'): plugins_path + ('modules', ),
-        ('ansible', 'module_utils'): plugins_path + ('module_utils', ),
-        ('ansible', 'plugins'): plugins_path,
-        ('units', ): unit_tests_path,
-    }
+    import_map = build_import_map(namespace, collection)
 
     return rewrite_imports_in_fst(mod_fst, import_map, collection, spec, namespace, args, options)
 
 
-def match_import_src(imp_src, import_map):
+def match_import_src(imp_src_tuple, import_map):
     """Find a replacement map entry matching the current import."""
-    try:
-        imp_src_tuple = tuple(t.value for t in imp_src)
-    except AttributeError as e:
-        # AttributeError("EllipsisNode instance has no attribute 'value' and 'value' is not a valid identifier of another node")
-        # lib/ansible/modules/system/setup.py:
-        # from ...module_utils.basic import AnsibleModule
-        logger.exception(e)
-        raise LookupError
-
     for old_imp, new_imp in import_map.items():
         token_length = len(old_imp)
         if imp_src_tuple[:token_length] != old_imp:
             continue
         return token_length, new_imp
 
-    raise LookupError(f"Couldn't find a replacement for {imp_src!s}")
+    raise LookupError(f"Couldn't find a replacement for {'.'.join(imp_src_tuple)!s}")
+
+
+def rewrite_import_src(imp_src_tuple, imp_targets, import_map, collection, spec, namespace, args, options):
+    """Compute the rewritten dotted path of an import.
+
+    ``imp_targets`` holds the names imported by a ``from`` import
+    and is ``None`` for plain imports. Return the new dotted path
+    and the collection dependency it introduces, if any.
+    Raise LookupError if the import should stay as is.
+    """
+    token_length, exchange = match_import_src(imp_src_tuple, import_map)
+    imp_targets_list = imp_targets or []
+
+    if not any('module_utils' in t for t in imp_src_tuple) and any('Base' in t for t in imp_targets_list):
+        # from ansible.plugins.lookup import LookupBase
+        # NOT 'from ansible.module_utils.azure_rm_common import AzureRMModuleBase'
+        raise LookupError('Skip imports of Base classes')
+
+    if any('loader' in t for t in imp_targets_list):
+        raise LookupError('Skip imports of loaders')
+
+    if any(t in ('AnsiblePlugin', 'PluginLoader') for t in imp_targets_list):
+        # from ansible.plugins import AnsiblePlugin
+        # from ansible.plugins.loader import PluginLoader
+        raise LookupError('Skip imports of plugin base classes')
+
+    if imp_src_tuple[0] == 'units':
+        return exchange + imp_src_tuple[token_length:], None
+    elif imp_src_tuple[1] == 'module_utils':
+        plugin_type = 'module_utils'
+        if imp_targets is not None:
+            plugin_name = '/'.join(imp_src_tuple[token_length:] + (imp_targets[0], ))
+        else:
+            plugin_name = '/'.join(imp_src_tuple[token_length:])
+
+        if not plugin_name:
+            # 'import ansible.module_utils'
+            raise LookupError('Nothing to rewrite in %s' % '.'.join(imp_src_tuple))
+    elif imp_src_tuple[1] == 'plugins':
+        if len(imp_src_tuple) > 3:
+            plugin_type = imp_src_tuple[2]
+            plugin_name = imp_src_tuple[3]
+        elif len(imp_src_tuple) == 3 and len(imp_targets_list) == 1:
+            # from ansible.plugins.connection import winrm
+            plugin_type = imp_src_tuple[2]
+            plugin_name = imp_targets_list[0]
+        else:
+            logger.error('Could not get plugin type or name from ' + '.'.join(imp_src_tuple) + '. Is this expected?')
+            raise LookupError('Could not get plugin type or name')
+    elif imp_src_tuple[1] == 'modules':
+        # in unit tests
+        plugin_type = 'modules'
+        if imp_targets is not None:
+            # from ansible.modules.network.nxos import nxos_bgp
+            plugin_name = '/'.join(imp_src_tuple[token_length:] + (imp_targets[0], ))
+        else:
+            # import ansible.modules.cloud.amazon.aws_api_gateway as agw
+            plugin_name = '/'.join(imp_src_tuple[token_length:])
+    else:
+        raise Exception('BUG: Could not process import: ' + '.'.join(imp_src_tuple))
+
+    try:
+        plugin_namespace, plugin_collection = get_plugin_collection(plugin_name, plugin_type, spec)
+    except LookupError:
+        if plugin_type not in ('modules', 'module_utils'):
+            # plugin not in spec, assuming it stays in core and skipping
+            raise
+
+        # from ansible.modules.cloud.amazon.aws_netapp_cvs_FileSystems import AwsCvsNetappFileSystem as fileSystem_module
+        # in this case aws_netapp_cvs_FileSystems is the module, not AwsCvsNetappFileSystem
+        # if it's not found either, the plugin is not in spec, assuming it stays in core and skipping
+        plugin_name = '/'.join(plugin_name.split('/')[:-1])
+        plugin_namespace, plugin_collection = get_plugin_collection(plugin_name, plugin_type, spec)
+
+    if plugin_collection in COLLECTION_SKIP_REWRITE:
+        # skip rewrite
+        raise LookupError('%s is not rewritable' % plugin_collection)
+
+    if args.fail_on_core_rewrite:
+        raise RuntimeError('Rewriting to %s.%s.%s' % (plugin_namespace, plugin_collection, plugin_name))
+
+    if plugin_collection.startswith('_'):
+        plugin_collection = plugin_collection[1:]
+
+    new_imp_src = list(exchange + imp_src_tuple[token_length:])  # replace the import
+
+    if plugin_type == 'modules' and not (args.preserve_module_subdirs or options.get('flatmap')):
+        plugin_subdirs_len = len(plugin_name.split('/')[:-1])
+        exchange_len = len(exchange)
+        del new_imp_src[exchange_len:exchange_len+plugin_subdirs_len]
+
+    dep = None
+    if (plugin_namespace, plugin_collection) != (namespace, collection):
+        new_imp_src[1] = plugin_namespace
+        new_imp_src[2] = plugin_collection
+        dep = (plugin_namespace, plugin_collection)
+
+    return tuple(new_imp_src), dep
 
 
 def rewrite_imports_in_fst(mod_fst, import_map, collection, spec, namespace, args, options):
@@ -991,113 +1867,90 @@ def rewrite_imports_in_fst(mod_fst, import_map, collection, spec, namespace, arg
     deps = []
     for imp in mod_fst.find_all(('import', 'from_import')):
         imp_src = imp.value
+        imp_targets = None
         if imp.type == 'import':
             imp_src = imp_src[0].value
+        else:
+            # RedBaron keeps the parentheses of ``from x import (a, b)`` among the targets
+            imp_targets = [t.value for t in imp.targets if t.type not in {'left_parenthesis', 'right_parenthesis'}]
+
+        try:
+            imp_src_tuple = tuple(t.value for t in imp_src)
+        except AttributeError as e:
+            # AttributeError("EllipsisNode instance has no attribute 'value' and 'value' is not a valid identifier of another node")
+            # lib/ansible/modules/system/setup.py:
+            # from ...module_utils.basic import AnsibleModule
+            logger.exception(e)
+            continue
 
         try:
-            token_length, exchange = match_import_src(imp_src, import_map)
+            new_imp_src, dep = rewrite_import_src(imp_src_tuple, imp_targets, import_map, collection, spec, namespace, args, options)
         except LookupError:
-            continue  # no matching imports
+            continue  # no matching imports or nothing to rewrite
 
-        if not imp.find('name', value='g:*module_utils*') and imp.find_all('name_as_name', value='g:*Base*'):
-            # from ansible.plugins.lookup import LookupBase
-            # NOT 'from ansible.module_utils.azure_rm_common import AzureRMModuleBase'
-            continue  # Skip imports of Base classes
+        imp_src[:] = new_imp_src  # replace the import
+        if dep is not None:
+            deps.append(dep)
 
-        if imp.find('name_as_name', value='g:*loader*'):
-            continue
+    return deps
 
-        if imp.find('name_as_name', value=('AnsiblePlugin', 'PluginLoader')):
-            # from ansible.plugins import AnsiblePlugin
-            # from ansible.plugins.loader import PluginLoader
-            continue
 
-        if imp_src[0].value == 'units':
-            imp_src[:token_length] = exchange  # replace the import
+def rewrite_imports_in_source(splicer, import_map, collection, spec, namespace, args, options):
+    """Offset-based counterpart of :func:`rewrite_imports_in_fst`."""
+    deps = []
+    for imp in splicer.imports():
+        if imp.level or imp.name_start is None:
+            # relative imports never match the import map
             continue
-        elif imp_src[1].value == 'module_utils':
-            plugin_type = 'module_utils'
-            try:
-                plugin_name = '/'.join([t.value for t in imp_src[token_length:]] + [imp.targets[0].value])
-            except AttributeError:
-                plugin_name = '/'.join(t.value for t in imp_src[token_length:])
-
-            if not plugin_name:
-                # 'from ansible.module_utils import distro'
-                plugin_name = imp.targets[0].value
-                # NOTE multiple targets? - git grep says there is not such case now
-                # NOTE 'from ansible.module_utils import $module as $alias'? - git grep says there is not such case now
-        elif imp_src[1].value == 'plugins':
-            try:
-                plugin_type = imp_src[2].value
-                plugin_name = imp_src[3].value
-            except IndexError:
-                if len(getattr(imp, 'targets', [])) == 1:
-                    # from ansible.plugins.connection import winrm
-                    plugin_name = imp.targets[0].value
-                else:
-                    logger.error('Could not get plugin type or name from ' + str(imp) + '. Is this expected?')
-                    continue
-        elif imp_src[1].value == 'modules':
-            # in unit tests
-            plugin_type = 'modules'
-            try:
-                # from ansible.modules.network.nxos import nxos_bgp
-                plugin_name = '/'.join([t.value for t in imp_src[token_length:]] + [imp.targets[0].value])
-            except AttributeError:
-                # import ansible.modules.cloud.amazon.aws_api_gateway as agw
-                plugin_name = '/'.join(t.value for t in imp_src[token_length:])
-        else:
-            raise Exception('BUG: Could not process import: ' + str(imp))
 
         try:
-            plugin_namespace, plugin_collection = get_plugin_collection(plugin_name, plugin_type, spec)
+            new_imp_src, dep = rewrite_import_src(imp.name_parts, imp.targets, import_map, collection, spec, namespace, args, options)
         except LookupError:
-            if plugin_type not in ('modules', 'module_utils'):
-                # plugin not in spec, assuming it stays in core and skipping
-                continue
+            continue  # no matching imports or nothing to rewrite
 
-            # from ansible.modules.cloud.amazon.aws_netapp_cvs_FileSystems import AwsCvsNetappFileSystem as fileSystem_module
-            # in this case aws_netapp_cvs_FileSystems is the module, not AwsCvsNetappFileSystem
-            try:
-                plugin_name = '/'.join(plugin_name.split('/')[:-1])
-                plugin_namespace, plugin_collection = get_plugin_collection(plugin_name, plugin_type, spec)
-            except LookupError:
-                # plugin not in spec, assuming it stays in core and skipping
-                continue
+        splicer.replace(imp.name_start, imp.name_end, '.'.join(new_imp_src))
+        if dep is not None:
+            deps.append(dep)
 
-        if plugin_collection in COLLECTION_SKIP_REWRITE:
-            # skip rewrite
-            continue
+    return deps
 
-        if args.fail_on_core_rewrite:
-            raise RuntimeError('Rewriting to %s.%s.%s' % (plugin_namespace, plugin_collection, plugin_name))
 
-        if plugin_collection.startswith('_'):
-            plugin_collection = plugin_collection[1:]
+@cached_rewrite()
+def rewrite_py(src, dest, collection, spec, namespace, args, options, plugin_type=None):
 
-        imp_src[:token_length] = exchange  # replace the import
+    # DOCUMENTABLE_PLUGINS contains `module`, we use `modules` (plural) so adding that too
+    rewrite_docs = not plugin_type or plugin_type in C.DOCUMENTABLE_PLUGINS + ('doc_fragments', 'modules')
 
-        if plugin_type == 'modules' and not (args.preserve_module_subdirs or options.get('flatmap')):
-            plugin_subdirs_len = len(plugin_name.split('/')[:-1])
-            exchange_len = len(exchange)
-            del imp_src[exchange_len:exchange_len+plugin_subdirs_len]
+    if not needs_fst_rewrite(read_text_from_file(src), rewrite_docs=rewrite_docs, class_property_file=dest):
+        logger.info('Nothing to rewrite in %s, copying as is', src)
+        rewrite_paths['copy'] += 1
+        materialize_file(src, dest, args.link_mode)
+        return ([], [])
 
-        if (plugin_namespace, plugin_collection) != (namespace, collection):
-            imp_src[1] = plugin_namespace
-            imp_src[2] = plugin_collection
-            deps.append((plugin_namespace, plugin_collection))
-
-    return deps
+    if args.rewrite_engine == 'ast':
+        try:
+            with splice_rewrite_session(src, dest) as splicer:
+                import_deps = rewrite_imports_in_source(splicer, build_import_map(namespace, collection), collection, spec, namespace, args, options)
 
+                docs_deps = []
+                if rewrite_docs:
+                    try:
+                        docs_deps = rewrite_plugin_documentation_in_source(splicer, collection, spec, namespace, args)
+                    except LookupError as err:
+                        logger.debug('%s in %s', err, src)
 
-def rewrite_py(src, dest, collection, spec, namespace, args, options, plugin_type=None):
+                rewrite_class_property_in_source(splicer, collection, namespace, dest)
+        except UnsupportedSourceLayout as err:
+            logger.info('Falling back to RedBaron for %s: %s', src, err)
+        else:
+            rewrite_paths['splice'] += 1
+            return (import_deps, docs_deps)
 
+    rewrite_paths['fst'] += 1
     with fst_rewrite_session(src, dest) as mod_fst:
         import_deps = rewrite_imports(mod_fst, collection, spec, namespace, args, options)
 
-        # DOCUMENTABLE_PLUGINS contains `module`, we use `modules` (plural) so adding that too
-        if not plugin_type or plugin_type in C.DOCUMENTABLE_PLUGINS + ('doc_fragments', 'modules'):
+        if rewrite_docs:
             try:
                 docs_deps = rewrite_plugin_documentation(mod_fst, collection, spec, namespace, args)
             except LookupError as err:
@@ -1111,6 +1964,72 @@ def rewrite_py(src, dest, collection, spec, namespace, args, options, plugin_typ
     return (import_deps, docs_deps)
 
 
+def _matches_rewrite_import_prefix(dotted_name):
+    imp_src_tuple = tuple(dotted_name.split('.'))
+    return any(imp_src_tuple[:len(prefix)] == prefix for prefix in REWRITE_IMPORT_PREFIXES)
+
+
+def _ast_str_value(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if sys.version_info < (3, 8) and isinstance(node, ast.Str):
+        return node.s
+    return None
+
+
+def needs_fst_rewrite(mod_src_text, *, rewrite_docs=False, class_property_file=None, unit_test_file=None):
+    """Tell whether the module has anything for the FST rewriters to do.
+
+    This is a cheap scan over the stdlib AST which errs on the side
+    of caution: a false positive only costs a full RedBaron parse.
+    """
+    try:
+        mod_ast = ast.parse(mod_src_text)
+    except (SyntaxError, ValueError):
+        return True
+
+    rewrite_class_property = (
+        class_property_file is not None
+        and any(f'plugins/{p}' in class_property_file for p in REWRITE_CLASS_PROPERTY_PLUGINS)
+    )
+    unit_test_dir = None if unit_test_file is None else os.path.dirname(unit_test_file)
+
+    for node in ast.walk(mod_ast):
+        if isinstance(node, ast.Import):
+            if any(_matches_rewrite_import_prefix(imp.name) for imp in node.names):
+                return True
+        elif isinstance(node, ast.ImportFrom):
+            if node.level or not node.module:
+                continue
+            if _matches_rewrite_import_prefix(node.module):
+                return True
+            if unit_test_dir is None or node.module == '__future__':
+                continue
+            # see normalize_implicit_relative_imports_in_unit_tests
+            *pkg_path_parts, pkg_or_mod = node.module.split('.')
+            relative_mod_path = os.path.join(unit_test_dir, *pkg_path_parts, f'{pkg_or_mod}.py')
+            relative_pkg_init_path = os.path.join(unit_test_dir, *pkg_path_parts, pkg_or_mod, '__init__.py')
+            if relative_mod_path == unit_test_file:  # self-import? nope! def other mod
+                continue
+            if os.path.exists(relative_mod_path) or os.path.exists(relative_pkg_init_path):
+                return True
+        elif isinstance(node, ast.Assign) and rewrite_docs:
+            if not any(isinstance(t, ast.Name) and t.id == 'DOCUMENTATION' for t in node.targets):
+                continue
+            doc_val = _ast_str_value(node.value)
+            if doc_val is None or any(needle in doc_val for needle in DOCUMENTATION_REWRITE_NEEDLES):
+                return True
+        elif isinstance(node, ast.ClassDef) and rewrite_class_property:
+            if node.name in REWRITE_CLASS_PROPERTY_MAP:
+                return True
+        elif unit_test_dir is not None:
+            str_val = _ast_str_value(node)
+            if str_val is not None and any(needle in str_val for needle in UNIT_TESTS_PATCH_NEEDLES):
+                return True
+
+    return False
+
+
 @contextlib.contextmanager
 def fst_rewrite_session(src_path, dst_path):
     """Parse the module FST and save it to disk afterwards."""
@@ -1118,7 +2037,25 @@ def fst_rewrite_session(src_path, dst_path):
 
     yield mod_fst
 
-    new_mod_src_text = mod_fst.dumps()
+    with run_timer.phase('redbaron_dump'):
+        new_mod_src_text = mod_fst.dumps()
+
+    if src_path == dst_path and mod_src_text == new_mod_src_text:
+        return
+
+    logger.info('Rewriting plugin references in %s', dst_path)
+    write_text_into_file(dst_path, new_mod_src_text)
+
+
+@contextlib.contextmanager
+def splice_rewrite_session(src_path, dst_path):
+    """Locate the rewrite targets by offsets and save the spliced source afterwards."""
+    mod_src_text = read_text_from_file(src_path)
+    splicer = SourceSplicer(mod_src_text)
+
+    yield splicer
+
+    new_mod_src_text = splicer.dumps()
 
     if src_path == dst_path and mod_src_text == new_mod_src_text:
         return
@@ -1131,7 +2068,8 @@ def read_module_txt_n_fst(path):
     """Parse module source code in form of Full Syntax Tree."""
     mod_src_text = read_text_from_file(path)
     try:
-        return mod_src_text, redbaron.RedBaron(mod_src_text)
+        with run_timer.phase('redbaron_parse'):
+            return mod_src_text, redbaron.RedBaron(mod_src_text)
     except ParsingError:
         logger.exception('failed parsing on %s', mod_src_text)
         raise
@@ -1224,7 +2162,8 @@ def inject_requirements_into_unit_tests(checkout_path, collection_dir):
     original_unit_tests_req_file = os.path.join(checkout_path, 'test', 'units', 'requirements.txt')
 
     os.makedirs(coll_unit_tests_dir, exist_ok=True)
-    shutil.copy(original_unit_tests_req_file, coll_unit_tests_dir)
+    # NOTE: it may have been hardlinked by copy_unit_tests already
+    materialize_file(original_unit_tests_req_file, os.path.join(coll_unit_tests_dir, 'requirements.txt'), copy_function=shutil.copy)
 
     logger.info('Unit tests deps injected into collection')
 
@@ -1251,31 +2190,34 @@ def create_unit_tests_copy_map(checkout_path, plugin_type, plugin):
     )
 
     unit_tests_relative_root = os.path.join('test', 'units')
-    collection_unit_tests_relative_root = os.path.join('tests', 'unit')
+    unit_tests_index = get_unit_tests_index(checkout_path)
 
     # Narrow down the search area
-    type_base_subdir = os.path.join(checkout_path, unit_tests_relative_root, type_subdir)
+    plugin_dir, plugin_mod = os.path.split(plugin)
+    search_dir = os.path.normpath(os.path.join(unit_tests_relative_root, type_subdir, plugin_dir))
 
     # Figure out what to copy and where
     copy_map = {}
 
-    # Find all test modules with the same ending as the current plugin
-    plugin_dir, plugin_mod = os.path.split(plugin)
-    matching_test_modules = set(glob.glob(os.path.join(
-        type_base_subdir,
-        plugin_dir,
-        f'*{plugin_mod}',
-    )))
     # plugin_mod might also be a directory, scan subdirs
-    plugin_mod = os.path.splitext(plugin_mod)[0]
-    if plugin_mod.startswith('_'):
-        plugin_mod = plugin_mod[1:]
-    matching_test_modules = matching_test_modules.union(set(glob.glob(os.path.join(
-        type_base_subdir,
-        plugin_dir,
-        f'*{plugin_mod}/**',
-    ), recursive=True)))
-    matching_test_modules = set(f for f in matching_test_modules if not os.path.isdir(f))
+    plugin_mod_stem = os.path.splitext(plugin_mod)[0]
+    if plugin_mod_stem.startswith('_'):
+        plugin_mod_stem = plugin_mod_stem[1:]
+
+    # Find all test modules with the same ending as the current plugin
+    matching_test_modules = set()
+    for entry in unit_tests_index.listdir(search_dir):
+        if entry.startswith('.'):
+            continue
+        entry_path = os.path.join(search_dir, entry)
+        if entry.endswith(plugin_mod) and unit_tests_index.has_file(entry_path):
+            matching_test_modules.add(os.path.join(checkout_path, entry_path))
+        if entry.endswith(plugin_mod_stem) and unit_tests_index.has_dir(entry_path):
+            matching_test_modules.update(
+                os.path.join(checkout_path, f)
+                for f in unit_tests_index.files_under(entry_path)
+                if not any(part.startswith('.') for part in os.path.relpath(f, entry_path).split('/'))
+            )
 
     # Path(matching_test_modules[0]).relative_to(Path(checkout_path))
     # os.path.relpath(matching_test_modules[0], checkout_path)
@@ -1297,7 +2239,7 @@ def create_unit_tests_copy_map(checkout_path, plugin_type, plugin):
             relative_target_path, _ = os.path.split(relative_target_path)
 
             target_file = os.path.join(tests_root, relative_target_path, needle_filename)
-            if not os.path.isfile(target_file):
+            if not unit_tests_index.has_file(os.path.relpath(target_file, checkout_path)):
                 continue
 
             logger.info('Located %s...', target_file)
@@ -1310,88 +2252,26 @@ def create_unit_tests_copy_map(checkout_path, plugin_type, plugin):
         for p in find_up_the_tree(m)
     )
 
-    def traverse_dir(path, relative_to):
-        rel_path = os.path.join(relative_to, path)
-        if not os.path.isdir(rel_path):
-            return {path}
-
-        matching_files = itertools.chain(
-            glob.iglob(
-                os.path.join(rel_path, '.**'),
-                recursive=True,
-            ),
-            glob.iglob(
-                os.path.join(rel_path, '**'),
-                recursive=True,
-            ),
-        )
-        return set(
-            os.path.relpath(p, relative_to)
-            for p in matching_files
-            if not os.path.isdir(p)
-        )
-
-    def replace_path_prefix(path):
-        return os.path.join(
-            collection_unit_tests_relative_root,
-            os.path.relpath(path, unit_tests_relative_root),
-        )
-
     # Inject unit test helper packages
     # TODO: figure out the bug with path maps
-    compat_mock_helpers = (
-        (
-            UnmovablePathStr(src_f),
-            replace_path_prefix(src_f),
-        )
-        for hd in {'compat', 'mock', 'modules/utils.py'}
-        for src_f in traverse_dir(
-            os.path.join(unit_tests_relative_root, hd),
-            checkout_path,
-        )
-    )
-    copy_map.update(compat_mock_helpers)
+    copy_map.update(get_unit_tests_helpers_copy_map(checkout_path))
 
     def discover_file_migrations(paths, *, find_related=False):
         """Generate the migration map for given paths.
 
         Optionally, traverse siblings.
         """
-        nonlocal unit_tests_relative_root
-
+        related_tds = set()
         for td, tm in map(os.path.split, paths):
             relative_td = os.path.relpath(td, checkout_path)
-            test_artifact_path = os.path.join(relative_td, tm)
-            yield (test_artifact_path, replace_path_prefix(test_artifact_path))
-
-            if not find_related:
-                continue
-
-            module_type = os.path.relpath(relative_td, unit_tests_relative_root)
+            test_artifact_path = os.path.join(relative_td, tm)
+            yield (test_artifact_path, get_collection_unit_tests_path(test_artifact_path))
 
-            if module_type in {'module_utils'}:
-                """Top-level dir of the module_utils unit tests."""
+            if not find_related or relative_td in related_tds:
                 continue
 
-            # Add subdirs that may contain related test artifacts/fixtures
-            # Also add important modules like conftest or __init__
-            related_test_fixtures = itertools.chain.from_iterable(
-                traverse_dir(
-                    os.path.join(relative_td, path),
-                    checkout_path,
-                )
-                for path in os.listdir(td)
-                if os.path.isdir(os.path.join(td, path))
-                or not path.startswith('test_')
-            )
-
-            yield from (
-                (
-                    test_artifact_path,
-                    replace_path_prefix(test_artifact_path),
-                )
-                for test_artifact_path in related_test_fixtures
-            )
+            related_tds.add(relative_td)
+            yield from get_related_unit_tests_fixtures(checkout_path, relative_td)
 
     copy_map.update(itertools.chain(
         (
@@ -1407,7 +2287,70 @@ def create_unit_tests_copy_map(checkout_path, plugin_type, plugin):
     return copy_map
 
 
-def copy_unit_tests(copy_map, collection_dir, checkout_path, namespace, collection):
+def get_collection_unit_tests_path(path):
+    """Map a path under test/units to the one in the collection."""
+    return os.path.join(
+        os.path.join('tests', 'unit'),
+        os.path.relpath(path, os.path.join('test', 'units')),
+    )
+
+
+def traverse_unit_tests_dir(checkout_path, path):
+    """Return the files under the dir, or the path itself if it is not a dir."""
+    unit_tests_index = get_unit_tests_index(checkout_path)
+    if not unit_tests_index.has_dir(path):
+        return {path}
+
+    return set(
+        p
+        for p in unit_tests_index.files_under(path)
+        if is_visible_to_glob(os.path.relpath(p, path))
+    )
+
+
+@functools.lru_cache()
+def get_unit_tests_helpers_copy_map(checkout_path):
+    """Return the copy map of the shared unit test helpers.
+
+    The result is shared between calls, do not modify it.
+    """
+    return {
+        UnmovablePathStr(src_f): get_collection_unit_tests_path(src_f)
+        for hd in {'compat', 'mock', 'modules/utils.py'}
+        for src_f in traverse_unit_tests_dir(checkout_path, os.path.join('test', 'units', hd))
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_related_unit_tests_fixtures(checkout_path, relative_td):
+    """Return the copy map items of the fixtures next to the test modules.
+
+    Those are the subdirs that may contain related test
+    artifacts/fixtures and the modules like conftest or __init__.
+    """
+    module_type = os.path.relpath(relative_td, os.path.join('test', 'units'))
+
+    if module_type in {'module_utils'}:
+        """Top-level dir of the module_utils unit tests."""
+        return ()
+
+    unit_tests_index = get_unit_tests_index(checkout_path)
+    related_test_fixtures = itertools.chain.from_iterable(
+        traverse_unit_tests_dir(checkout_path, os.path.join(relative_td, path))
+        for path in unit_tests_index.listdir(relative_td)
+        if unit_tests_index.has_dir(os.path.join(relative_td, path))
+        or not path.startswith('test_')
+    )
+    return tuple(
+        (
+            test_artifact_path,
+            get_collection_unit_tests_path(test_artifact_path),
+        )
+        for test_artifact_path in related_test_fixtures
+    )
+
+
+def copy_unit_tests(copy_map, collection_dir, checkout_path, namespace, collection, link_mode='copy'):
     """Copy unit tests into a collection using a copy map."""
     if not copy_map:
         logger.info('No unit tests scheduled for copying to %s', collection_dir)
@@ -1425,7 +2368,7 @@ def copy_unit_tests(copy_map, collection_dir, checkout_path, namespace, collecti
 
         src = os.path.join(checkout_path, src_f)
         logger.info('Migrating %s -> %s', src, dest)
-        shutil.copy(src, dest)
+        materialize_file(src, dest, link_mode, shutil.copy)
 
         if should_be_preserved:
             continue
@@ -1438,16 +2381,27 @@ def copy_unit_tests(copy_map, collection_dir, checkout_path, namespace, collecti
 
 def assemble_collections(checkout_path, spec, args, target_github_org):
     collections_base_dir = os.path.join(args.vardir, 'collections')
+    journal_path = os.path.join(args.vardir, CHECKPOINTS_JOURNAL_REL_PATH)
+    run_digest = get_checkpoints_run_digest(spec, args)
 
     # expand globs so we deal with specific paths
-    resolve_spec(spec, checkout_path)
+    with run_timer.phase('resolve_spec'):
+        resolve_spec(spec, checkout_path)
+
+    journal_header, checkpoints = None, []
+    if args.resume:
+        journal_header, checkpoints = load_resumable_checkpoints(journal_path, run_digest, checkout_path)
 
     # ensure we always use a clean copy
-    if args.refresh and os.path.exists(collections_base_dir):
+    if args.refresh and journal_header is None and os.path.exists(collections_base_dir):
         shutil.rmtree(collections_base_dir)
 
-    # make initial YAML transformation to minimize the diff
-    mark_moved_resources(checkout_path, 'N/A', 'init', {})
+    if journal_header is None:
+        devel_commit = git_rev_parse_head(checkout_path)
+        # make initial YAML transformation to minimize the diff
+        mark_moved_resources(checkout_path, 'N/A', 'init', {})
+        journal_header = {'run_digest': run_digest, 'devel_commit': devel_commit, 'init_head': git_rev_parse_head(checkout_path)}
+    write_checkpoints_journal(journal_path, journal_header, checkpoints)
 
     # get module defaults
     module_defaults = {}
@@ -1459,7 +2413,14 @@ def assemble_collections(checkout_path, spec, args, target_github_org):
     # to build routing in core
     resolved = {}
 
-    # main loop over spec
+    for checkpoint in checkpoints:
+        logger.info('Resuming with the recorded build of %s.%s', checkpoint['namespace'], checkpoint['collection'])
+        merge_collection_contributions(checkpoint['contributions'])
+        merge_resolved_routing(resolved, checkpoint['resolved'])
+    finished_collections = {(checkpoint['namespace'], checkpoint['collection']) for checkpoint in checkpoints}
+
+    # pick the collections to build
+    collections_to_build = []
     for namespace in spec.keys():
 
         for collection in spec[namespace].keys():
@@ -1478,14 +2439,6 @@ def assemble_collections(checkout_path, spec, args, target_github_org):
                     logger.info('%s.%s did not match filters, skipping' % (namespace, collection))
                     continue
 
-            action_defaults = {}
-            import_deps = []
-            docs_deps = []
-            unit_deps = []
-            integration_test_dirs = []
-            migrated_to_collection = {}
-            unit_tests_copy_map = {}
-
             if args.fail_on_core_rewrite:
                 if collection != '_core':
                     continue
@@ -1494,203 +2447,468 @@ def assemble_collections(checkout_path, spec, args, target_github_org):
                 continue
 
             options = spec[namespace][collection].pop('_options', {})
+            if (namespace, collection) in finished_collections:
+                continue
+            collections_to_build.append((namespace, collection, options))
+
+    if not args.skip_tests:
+        # build these once for all the collections, pool workers inherit them
+        get_integration_targets_graph(checkout_path)
+        get_unit_tests_index(checkout_path)
+        get_unit_tests_helpers_copy_map(checkout_path)
+
+    # build these once in the parent, the pool workers inherit them
+    for plugin_type in JINJA_PLUGIN_CLASSES:
+        get_jinja_plugin_map(plugin_type, spec, checkout_path, args.vardir)
+
+    assemble = functools.partial(
+        assemble_collection,
+        checkout_path, spec, args, target_github_org,
+        collections_base_dir, module_defaults,
+    )
 
-            collection_dir = os.path.join(collections_base_dir, 'ansible_collections', namespace, collection)
+    # main loop over spec
+    if args.jobs > 1:
+        # NOTE: the workers rely on inheriting the resolved spec, the plugin
+        # NOTE: index and ALL_THE_FILES from the parent process, hence fork
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.jobs,
+                mp_context=multiprocessing.get_context('fork'),
+        ) as pool:
+            futures = [
+                pool.submit(assemble_collection_in_worker, assemble, namespace, collection, options)
+                for namespace, collection, options in collections_to_build
+            ]
+            # merge in the spec order to keep the result deterministic
+            for (namespace, collection, _options), future in zip(collections_to_build, futures):
+                coll_resolved, migrated_to_collection, contributions = future.result()
+                merge_collection_contributions(contributions)
+                merge_resolved_routing(resolved, coll_resolved)
+                with run_timer.phase('git', key='mark_moved_resources'):
+                    mark_moved_resources(checkout_path, namespace, collection, migrated_to_collection)
+                append_checkpoint(journal_path, checkout_path, namespace, collection, coll_resolved, migrated_to_collection, contributions)
+    else:
+        for namespace, collection, options in collections_to_build:
+            coll_resolved, migrated_to_collection, contributions = assemble_collection_in_process(assemble, namespace, collection, options)
+            merge_collection_contributions(contributions)
+            merge_resolved_routing(resolved, coll_resolved)
+            with run_timer.phase('git', key='mark_moved_resources'):
+                mark_moved_resources(checkout_path, namespace, collection, migrated_to_collection)
+            append_checkpoint(journal_path, checkout_path, namespace, collection, coll_resolved, migrated_to_collection, contributions)
 
-            if args.refresh and os.path.exists(collection_dir):
-                shutil.rmtree(collection_dir)
+    # handle aliases in core
+    with run_timer.phase('git', key='core_routing'):
+        write_core_routing(resolved, checkout_path)
 
-            if not os.path.exists(collection_dir):
-                os.makedirs(collection_dir)
+    # remove from src repo if required
+    if args.move_plugins:
+        with run_timer.phase('git', key='core_removal'):
+            actually_remove(checkout_path, squash=args.squash_core_removals)
 
-            # create the data for galaxy.yml
-            galaxy_metadata = init_galaxy_metadata(collection, namespace, target_github_org, options)
-            if options.get('flatmap'):
-                galaxy_metadata['type'] = 'flatmap'
 
-            # process each plugin type
-            for plugin_type, plugins in spec[namespace][collection].items():
+def assemble_collection(checkout_path, spec, args, target_github_org, collections_base_dir, module_defaults, namespace, collection, options):
+    """Build a collection, timing it and profiling if requested."""
+    coll_fqdn = f'{namespace}.{collection}'
+    pstats_path = os.path.join(args.vardir, 'profile', f'{coll_fqdn}.pstats') if args.profile else None
+    with profile_into(pstats_path), run_timer.phase('collection', key=coll_fqdn):
+        return _assemble_collection(checkout_path, spec, args, target_github_org, collections_base_dir, module_defaults, namespace, collection, options)
 
-                if not plugins:
-                    logger.error('Empty plugin_type: %s in spec for %s.%s', plugin_type, namespace, collection)
-                    continue
 
-                if plugin_type not in resolved and plugin_type not in NOT_PLUGINS:
-                    resolved[plugin_type] = {}
+def _assemble_collection(checkout_path, spec, args, target_github_org, collections_base_dir, module_defaults, namespace, collection, options):
+    """Build a single collection out of its spec.
 
-                # get src plugin path
-                src_plugin_base = PLUGIN_EXCEPTION_PATHS.get(plugin_type, os.path.join('lib', 'ansible', 'plugins', plugin_type))
+    Return the core routing entries and the migrated files map
+    for the collection.
+    """
+    action_defaults = {}
+    resolved = {}
+    import_deps = []
+    docs_deps = []
+    unit_deps = []
+    integration_test_dirs = []
+    migrated_to_collection = {}
+    unit_tests_copy_map = {}
 
-                # ensure destinations exist
-                if plugin_type in PLUGIN_DEST_EXCEPTION_PATHS:
-                    relative_dest_plugin_base = PLUGIN_DEST_EXCEPTION_PATHS[plugin_type]
-                else:
-                    relative_dest_plugin_base = os.path.join('plugins', plugin_type)
-                dest_plugin_base = os.path.join(collection_dir, relative_dest_plugin_base)
-                if not os.path.exists(dest_plugin_base):
-                    os.makedirs(dest_plugin_base)
-                    write_text_into_file(os.path.join(dest_plugin_base, '__init__.py'), '')
-
-                # process each plugin
-                for plugin in plugins:
-                    if os.path.splitext(plugin)[1] in BAD_EXT:
-                        raise Exception("We should not be migrating compiled files: %s" % plugin)
-
-                    # TODO: currently requires 'full name of file', but should work w/o extension?
-                    relative_src_plugin_path = os.path.join(src_plugin_base, plugin)
-                    src = os.path.join(checkout_path, relative_src_plugin_path)
-
-                    do_preserve_subdirs = (((args.preserve_module_subdirs or options.get('flatmap')) and plugin_type == 'modules')
-                                          or plugin_type in ALWAYS_PRESERVE_SUBDIRS)
-                    plugin_path_chunk = plugin if do_preserve_subdirs else os.path.basename(plugin)
-
-                    # use pname as 'pinal name' so we can handle deprecated content
-                    pname = os.path.splitext(os.path.basename(plugin))[0]
-                    if pname.startswith('_') and pname != '__init__' and plugin_type != 'module_utils':
-                        oldname = pname
-                        pname = pname[1:]
-                        deprecate(namespace, collection, plugin_type, pname)
-                        plugin_path_chunk = plugin_path_chunk.replace(oldname, pname)
-
-                    relative_dest_plugin_path = os.path.join(relative_dest_plugin_base, plugin_path_chunk)
-
-                    # add to core routing.yml, skip init files
-                    if os.path.basename(src) != '__init__.py' and plugin_type not in NOT_PLUGINS:
-                        resolved[plugin_type][pname] = {'redirect': get_plugin_fqcn(namespace, collection, pname)}
-
-                    # use pname to check module_defaults and add to action_groups.yml
-                    if pname in module_defaults:
-                        for groupname in module_defaults[pname]:
-                            if groupname not in action_defaults:
-                                action_defaults[groupname] = []
-                            action_defaults[groupname].append(pname)
-
-                    # add plugin to remove
-                    remove(src, namespace, collection)
+    collection_dir = os.path.join(collections_base_dir, 'ansible_collections', namespace, collection)
 
-                    # mark botmeta as migrated
-                    migrated_to_collection[relative_src_plugin_path] = relative_dest_plugin_path
+    if args.refresh and os.path.exists(collection_dir):
+        shutil.rmtree(collection_dir)
 
-                    # prep destnation
-                    dest = os.path.join(collection_dir, relative_dest_plugin_path)
-                    if do_preserve_subdirs:
-                        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if not os.path.exists(collection_dir):
+        os.makedirs(collection_dir)
 
-                    if os.path.islink(src):
-                        process_symlink(spec, plugins, plugin_type, dest, src)
-                    elif not src.endswith('.py') or (plugin_type == 'modules' and os.path.basename(src) == '__init__.py'):
-                        # Just copy and skip processing for both 'non python' and
-                        # __init__.py in lib/ansible/modules are empty.
-                        # this saves us from doing all the processing on them and
-                        # also from giving false positives in unit tests discovery
-                        # TODO: eventualy handle powershell?
-                        logger.info('Copying %s -> %s', src, dest)
-                        shutil.copyfile(src, dest)
-                        continue
+    # create the data for galaxy.yml
+    galaxy_metadata = init_galaxy_metadata(collection, namespace, target_github_org, options)
+    if options.get('flatmap'):
+        galaxy_metadata['type'] = 'flatmap'
 
-                    logger.info('Processing %s -> %s', src, dest)
+    # process each plugin type
+    for plugin_type, plugins in spec[namespace][collection].items():
 
-                    deps = rewrite_py(src, dest, collection, spec, namespace, args, options, plugin_type=plugin_type)
-                    import_deps += deps[0]
-                    docs_deps += deps[1]
+        if not plugins:
+            logger.error('Empty plugin_type: %s in spec for %s.%s', plugin_type, namespace, collection)
+            continue
 
-                    if args.skip_tests or plugin_type in NOT_PLUGINS:
-                        # skip rest for 'not really plugins'
-                        continue
+        if plugin_type not in resolved and plugin_type not in NOT_PLUGINS:
+            resolved[plugin_type] = {}
 
-                    # use undeprecated name to find tests
-                    integration_test_dirs.extend(discover_integration_tests(checkout_path, plugin_type, pname))
+        # get src plugin path
+        src_plugin_base = PLUGIN_EXCEPTION_PATHS.get(plugin_type, os.path.join('lib', 'ansible', 'plugins', plugin_type))
 
-                    # process unit tests
-                    plugin_unit_tests_copy_map = create_unit_tests_copy_map(checkout_path, plugin_type, plugin)
-                    unit_tests_copy_map.update(plugin_unit_tests_copy_map)
+        # ensure destinations exist
+        if plugin_type in PLUGIN_DEST_EXCEPTION_PATHS:
+            relative_dest_plugin_base = PLUGIN_DEST_EXCEPTION_PATHS[plugin_type]
+        else:
+            relative_dest_plugin_base = os.path.join('plugins', plugin_type)
+        dest_plugin_base = os.path.join(collection_dir, relative_dest_plugin_base)
+        if not os.path.exists(dest_plugin_base):
+            os.makedirs(dest_plugin_base)
+            write_text_into_file(os.path.join(dest_plugin_base, '__init__.py'), '')
+
+        # process each plugin
+        for plugin in run_timer.iter_phase('plugin_type', plugins, key=plugin_type):
+            if os.path.splitext(plugin)[1] in BAD_EXT:
+                raise Exception("We should not be migrating compiled files: %s" % plugin)
+
+            # TODO: currently requires 'full name of file', but should work w/o extension?
+            relative_src_plugin_path = os.path.join(src_plugin_base, plugin)
+            src = os.path.join(checkout_path, relative_src_plugin_path)
+
+            do_preserve_subdirs = (((args.preserve_module_subdirs or options.get('flatmap')) and plugin_type == 'modules')
+                                  or plugin_type in ALWAYS_PRESERVE_SUBDIRS)
+            plugin_path_chunk = plugin if do_preserve_subdirs else os.path.basename(plugin)
+
+            # use pname as 'pinal name' so we can handle deprecated content
+            pname = os.path.splitext(os.path.basename(plugin))[0]
+            if pname.startswith('_') and pname != '__init__' and plugin_type != 'module_utils':
+                oldname = pname
+                pname = pname[1:]
+                deprecate(namespace, collection, plugin_type, pname)
+                plugin_path_chunk = plugin_path_chunk.replace(oldname, pname)
+
+            relative_dest_plugin_path = os.path.join(relative_dest_plugin_base, plugin_path_chunk)
+
+            # add to core routing.yml, skip init files
+            if os.path.basename(src) != '__init__.py' and plugin_type not in NOT_PLUGINS:
+                resolved[plugin_type][pname] = {'redirect': get_plugin_fqcn(namespace, collection, pname)}
+
+            # use pname to check module_defaults and add to action_groups.yml
+            if pname in module_defaults:
+                for groupname in module_defaults[pname]:
+                    if groupname not in action_defaults:
+                        action_defaults[groupname] = []
+                    action_defaults[groupname].append(pname)
+
+            # add plugin to remove
+            remove(src, namespace, collection)
+
+            # mark botmeta as migrated
+            migrated_to_collection[relative_src_plugin_path] = relative_dest_plugin_path
+
+            # prep destnation
+            dest = os.path.join(collection_dir, relative_dest_plugin_path)
+            if do_preserve_subdirs:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+            if os.path.islink(src):
+                process_symlink(spec, plugins, plugin_type, dest, src)
+            elif not src.endswith('.py') or (plugin_type == 'modules' and os.path.basename(src) == '__init__.py'):
+                # Just copy and skip processing for both 'non python' and
+                # __init__.py in lib/ansible/modules are empty.
+                # this saves us from doing all the processing on them and
+                # also from giving false positives in unit tests discovery
+                # TODO: eventualy handle powershell?
+                logger.info('Copying %s -> %s', src, dest)
+                materialize_file(src, dest, args.link_mode)
+                continue
 
-            # copy license file
-            lfile = options.get('license_file', 'COPYING')
-            shutil.copyfile(os.path.join(checkout_path, 'COPYING'), os.path.join(collection_dir, lfile))
+            logger.info('Processing %s -> %s', src, dest)
 
-            if not args.skip_tests:
-                copy_unit_tests(unit_tests_copy_map, collection_dir, checkout_path, namespace, collection)
-                migrated_to_collection.update(unit_tests_copy_map)
+            deps = rewrite_py(src, dest, collection, spec, namespace, args, options, plugin_type=plugin_type)
+            import_deps += deps[0]
+            docs_deps += deps[1]
 
-                inject_init_into_tree(os.path.join(collection_dir, 'tests', 'unit'))
+            if args.skip_tests or plugin_type in NOT_PLUGINS:
+                # skip rest for 'not really plugins'
+                continue
 
-                unit_deps += rewrite_unit_tests(collection_dir, collection, spec, namespace, args, options)
+            # use undeprecated name to find tests
+            integration_test_dirs.extend(discover_integration_tests(checkout_path, plugin_type, pname))
 
-                inject_gitignore_into_tests(collection_dir)
+            # process unit tests
+            with run_timer.phase('unit_tests_discovery'):
+                plugin_unit_tests_copy_map = create_unit_tests_copy_map(checkout_path, plugin_type, plugin)
+            unit_tests_copy_map.update(plugin_unit_tests_copy_map)
 
-                inject_requirements_into_sanity_tests(checkout_path, collection_dir)
+    # copy license file
+    lfile = options.get('license_file', 'COPYING')
+    materialize_file(os.path.join(checkout_path, 'COPYING'), os.path.join(collection_dir, lfile), args.link_mode)
 
-                try:
-                    migrated_integration_test_files = rewrite_integration_tests(integration_test_dirs, checkout_path, collection_dir, namespace, collection, spec, args, options)
-                    migrated_to_collection.update(migrated_integration_test_files)
-                except yaml.composer.ComposerError as e:
-                    logger.error(e)
-
-                global integration_tests_deps
-                add_deps_to_metadata(set(import_deps).union(docs_deps), galaxy_metadata)
-
-                # FIXME the format of test dependencies metadata is still TBD,
-                # for now doing the below and separating integration and unit tests dependencies for debugging purposes
-                if integration_tests_deps or unit_deps:
-                    test_metadata = {
-                        'integration_tests_dependencies': [],
-                        'unit_tests_dependencies': [],
-                    }
-                    for dep_ns, dep_coll in set(integration_tests_deps):
-                        dep = '%s.%s' % (dep_ns, dep_coll)
-                        test_metadata['integration_tests_dependencies'].append(dep)
-                    for dep_ns, dep_coll in set(unit_deps):
-                        dep = '%s.%s' % (dep_ns, dep_coll)
-                        test_metadata['unit_tests_dependencies'].append(dep)
-                    write_yaml_into_file_as_is(os.path.join(collection_dir, 'tests', 'requirements.yml'), test_metadata)
-
-                integration_tests_deps = set()
-
-                inject_ignore_into_sanity_tests(
-                    # NOTE: This must be kept in the end of the block
-                    # NOTE: and migrated_to_collection mustn't be
-                    # NOTE: updated after this invocation.
-                    # Ref: ansible-community/collection_migration#364
-                    checkout_path, collection_dir,
-                    migrated_to_collection,
-                )
+    if not args.skip_tests:
+        copy_unit_tests(unit_tests_copy_map, collection_dir, checkout_path, namespace, collection, args.link_mode)
+        migrated_to_collection.update(unit_tests_copy_map)
 
-            inject_gitignore_into_collection(collection_dir)
-            j2_ctx = {
-                'coll_ns': namespace,
-                'coll_name': collection,
-                'gh_org': target_github_org,
-            }
-            inject_readme_into_collection(collection_dir, ctx=j2_ctx)
-            inject_github_actions_workflow_into_collection(collection_dir, ctx=j2_ctx)
+        inject_init_into_tree(os.path.join(collection_dir, 'tests', 'unit'))
+
+        unit_deps += rewrite_unit_tests(collection_dir, collection, spec, namespace, args, options)
 
-            # write collection metadata
-            write_yaml_into_file_as_is(os.path.join(collection_dir, 'galaxy.yml'), galaxy_metadata)
-            # write action defaults if needed
-            if action_defaults:
-                metadir = os.path.join(collection_dir,'meta')
-                if not os.path.exists(metadir):
-                    os.mkdir(metadir)
-                write_yaml_into_file_as_is(os.path.join(metadir, 'action_groups.yml'), action_defaults)
+        inject_gitignore_into_tests(collection_dir)
 
-            mark_moved_resources(checkout_path, namespace, collection, migrated_to_collection)
+        inject_requirements_into_sanity_tests(checkout_path, collection_dir)
 
-            # handle deprecations and aliases, per collection
-            coll_dir = os.path.join(collections_base_dir, 'ansible_collections')
-            write_collection_routing(coll_dir, namespace, collection)
+        try:
+            with run_timer.phase('integration_tests'):
+                migrated_integration_test_files = rewrite_integration_tests(integration_test_dirs, checkout_path, collection_dir, namespace, collection, spec, args, options)
+            migrated_to_collection.update(migrated_integration_test_files)
+        except yaml.composer.ComposerError as e:
+            logger.error(e)
+
+        global integration_tests_deps
+        add_deps_to_metadata(set(import_deps).union(docs_deps), galaxy_metadata)
+
+        # FIXME the format of test dependencies metadata is still TBD,
+        # for now doing the below and separating integration and unit tests dependencies for debugging purposes
+        if integration_tests_deps or unit_deps:
+            test_metadata = {
+                'integration_tests_dependencies': [],
+                'unit_tests_dependencies': [],
+            }
+            for dep_ns, dep_coll in set(integration_tests_deps):
+                dep = '%s.%s' % (dep_ns, dep_coll)
+                test_metadata['integration_tests_dependencies'].append(dep)
+            for dep_ns, dep_coll in set(unit_deps):
+                dep = '%s.%s' % (dep_ns, dep_coll)
+                test_metadata['unit_tests_dependencies'].append(dep)
+            write_yaml_into_file_as_is(os.path.join(collection_dir, 'tests', 'requirements.yml'), test_metadata)
+
+        integration_tests_deps = set()
+
+        inject_ignore_into_sanity_tests(
+            # NOTE: This must be kept in the end of the block
+            # NOTE: and migrated_to_collection mustn't be
+            # NOTE: updated after this invocation.
+            # Ref: ansible-community/collection_migration#364
+            checkout_path, collection_dir,
+            migrated_to_collection,
+        )
 
-            # init git repo
+    inject_gitignore_into_collection(collection_dir)
+    j2_ctx = {
+        'coll_ns': namespace,
+        'coll_name': collection,
+        'gh_org': target_github_org,
+    }
+    inject_readme_into_collection(collection_dir, ctx=j2_ctx)
+    inject_github_actions_workflow_into_collection(collection_dir, ctx=j2_ctx)
+
+    # write collection metadata
+    write_yaml_into_file_as_is(os.path.join(collection_dir, 'galaxy.yml'), galaxy_metadata)
+    # write action defaults if needed
+    if action_defaults:
+        metadir = os.path.join(collection_dir,'meta')
+        if not os.path.exists(metadir):
+            os.mkdir(metadir)
+        write_yaml_into_file_as_is(os.path.join(metadir, 'action_groups.yml'), action_defaults)
+
+    # handle deprecations and aliases, per collection
+    coll_dir = os.path.join(collections_base_dir, 'ansible_collections')
+    write_collection_routing(coll_dir, namespace, collection)
+
+    # init git repo
+    with run_timer.phase('git', key='collection_repo'):
+        if args.git_fast_import:
+            git_init_with_fast_import(collection_dir, 'Initial commit')
+        else:
             subprocess.check_call(('git', 'init'), cwd=collection_dir)
             subprocess.check_call(('git', 'add', '.'), cwd=collection_dir)
             subprocess.check_call(('git', 'commit', '-m', 'Initial commit', '--allow-empty'), cwd=collection_dir)
 
-    # handle aliases in core
-    write_core_routing(resolved, checkout_path)
+    return resolved, migrated_to_collection
 
-    # remove from src repo if required
-    if args.move_plugins:
-        actually_remove(checkout_path)
+
+def assemble_collection_in_worker(assemble, namespace, collection, options):
+    """Build a collection in a pool worker.
+
+    Return what :func:`assemble_collection` does along with
+    the contributions to the global state it has made.
+    """
+    global ALIAS, DEPRECATE, REMOVE, core, manual_check, rewrite_paths
+
+    ALIAS = {}
+    DEPRECATE = {}
+    REMOVE = defaultdict(lambda: defaultdict(set))
+    core = {}
+    manual_check = defaultdict(list)
+    rewrite_paths = Counter()
+    run_timer.reset()
+
+    coll_resolved, migrated_to_collection = assemble(namespace, collection, options)
+
+    contributions = {
+        'ALIAS': ALIAS,
+        'DEPRECATE': DEPRECATE,
+        'REMOVE': {ns: dict(coll_map) for ns, coll_map in REMOVE.items()},
+        'core': core,
+        'manual_check': dict(manual_check),
+        'rewrite_paths': rewrite_paths,
+        'timings': run_timer.snapshot(),
+    }
+    return coll_resolved, migrated_to_collection, contributions
+
+
+def assemble_collection_in_process(assemble, namespace, collection, options):
+    """Build a collection in this process like a pool worker does.
+
+    The global state is restored afterwards, the contributions
+    are to be merged into it by the caller.
+    """
+    global ALIAS, DEPRECATE, REMOVE, core, manual_check, rewrite_paths
+
+    global_state = ALIAS, DEPRECATE, REMOVE, core, manual_check, rewrite_paths
+    timings = run_timer.snapshot()
+    try:
+        return assemble_collection_in_worker(assemble, namespace, collection, options)
+    finally:
+        ALIAS, DEPRECATE, REMOVE, core, manual_check, rewrite_paths = global_state
+        run_timer.reset()
+        run_timer.merge(timings)
+
+
+def merge_collection_contributions(contributions):
+    """Merge the global state contributions of a built collection."""
+    for namespace, coll_map in contributions['ALIAS'].items():
+        for collection, ptype_map in coll_map.items():
+            for ptype, plugins in ptype_map.items():
+                ALIAS.setdefault(namespace, {}).setdefault(collection, {}).setdefault(ptype, {}).update(plugins)
+
+    for namespace, coll_map in contributions['DEPRECATE'].items():
+        for collection, ptype_map in coll_map.items():
+            for ptype, plugins in ptype_map.items():
+                DEPRECATE.setdefault(namespace, {}).setdefault(collection, {}).setdefault(ptype, []).extend(plugins)
+
+    for namespace, coll_map in contributions['REMOVE'].items():
+        for collection, paths in coll_map.items():
+            REMOVE[namespace][collection].update(paths)
+
+    for ptype, names in contributions['core'].items():
+        core.setdefault(ptype, set()).update(names)
+
+    for filename, checks in contributions['manual_check'].items():
+        manual_check[filename].extend(checks)
+
+    rewrite_paths.update(contributions['rewrite_paths'])
+    if 'timings' in contributions:
+        run_timer.merge(contributions['timings'])
+
+
+def merge_resolved_routing(resolved, coll_resolved):
+    """Merge the core routing entries of a collection."""
+    for plugin_type, plugins in coll_resolved.items():
+        resolved.setdefault(plugin_type, {}).update(plugins)
+
+
+### Checkpoints
+
+def git_rev_parse_head(checkout_dir):
+    return subprocess.check_output(('git', 'rev-parse', 'HEAD'), cwd=checkout_dir, text=True).strip()
+
+
+def get_checkpoints_run_digest(spec, args):
+    """Digest the inputs a resumed run must share with the journaled one."""
+    return hashlib.sha256(repr([
+        spec,
+        args.limits,
+        args.skip_tests,
+        args.fail_on_core_rewrite,
+        args.preserve_module_subdirs,
+        args.convert_symlinks,
+        args.rewrite_engine,
+        args.yaml_rewrite_mode,
+        args.link_mode,
+    ]).encode()).hexdigest()
+
+
+def read_checkpoints_journal(journal_path):
+    """Return the header and the collection records of the journal.
+
+    A record cut short by a crash while appending it is dropped.
+    """
+    records = []
+    with open(journal_path, 'rb') as journal:
+        header = pickle.load(journal)
+        while True:
+            try:
+                records.append(pickle.load(journal))
+            except (EOFError, pickle.UnpicklingError):
+                break
+    return header, records
+
+
+def write_checkpoints_journal(journal_path, header, records):
+    """Start the journal over with the header and the records.
+
+    The old journal is only replaced once the new one is complete.
+    """
+    os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    tmp_journal_path = f'{journal_path}.{os.getpid()}.tmp'
+    with open(tmp_journal_path, 'wb') as journal:
+        pickle.dump(header, journal)
+        for record in records:
+            pickle.dump(record, journal)
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(tmp_journal_path, journal_path)
+
+
+def append_checkpoint(journal_path, checkout_dir, namespace, collection, coll_resolved, migrated_to_collection, contributions):
+    """Record a collection as built along with its global state contributions."""
+    record = {
+        'namespace': namespace,
+        'collection': collection,
+        'resolved': coll_resolved,
+        'migrated_to_collection': migrated_to_collection,
+        'contributions': {key: value for key, value in contributions.items() if key != 'timings'},
+        # Core HEAD with the collection marked in BOTMETA
+        'devel_head': git_rev_parse_head(checkout_dir),
+    }
+    with open(journal_path, 'ab') as journal:
+        pickle.dump(record, journal)
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def load_resumable_checkpoints(journal_path, run_digest, checkout_path):
+    """Return the journal header and the collections to resume with.
+
+    The BOTMETA marks are replayed if Core has been checked out afresh
+    at the commit the journal was started from. ``(None, [])`` means
+    starting over.
+    """
+    try:
+        header, checkpoints = read_checkpoints_journal(journal_path)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        logger.info('No checkpoints to resume from in %s', journal_path)
+        return None, []
+
+    if header['run_digest'] != run_digest:
+        logger.warning('The spec or options differ from the checkpointed run, starting over')
+        return None, []
+
+    head = git_rev_parse_head(checkout_path)
+    marked_head = checkpoints[-1]['devel_head'] if checkpoints else header['init_head']
+    if head == marked_head:
+        return header, checkpoints
+    if head != header['devel_commit']:
+        logger.warning('Core is at %s instead of %s the checkpoints were built against, starting over', head, header['devel_commit'])
+        return None, []
+
+    logger.info('Replaying the BOTMETA marks of %d checkpointed collections', len(checkpoints))
+    mark_moved_resources(checkout_path, 'N/A', 'init', {})
+    header = dict(header, init_head=git_rev_parse_head(checkout_path))
+    for checkpoint in checkpoints:
+        mark_moved_resources(checkout_path, checkpoint['namespace'], checkpoint['collection'], checkpoint['migrated_to_collection'])
+        checkpoint['devel_head'] = git_rev_parse_head(checkout_path)
+    return header, checkpoints
 
 
 def init_galaxy_metadata(collection, namespace, target_github_org, options):
@@ -1763,6 +2981,25 @@ def rewrite_unit_tests(collection_dir, collection, spec, namespace, args, option
             (os.path.join(dp, f) for f in fn if f.endswith('.py'))
             for dp, dn, fn in os.walk(os.path.join(collection_dir, 'tests', 'unit'))
     ):
+        if not needs_fst_rewrite(read_text_from_file(file_path), unit_test_file=file_path):
+            rewrite_paths['copy'] += 1
+            continue
+
+        if args.rewrite_engine == 'ast':
+            try:
+                with splice_rewrite_session(file_path, file_path) as splicer:
+                    import_map = build_import_map(namespace, collection)
+                    unit_test_deps = rewrite_imports_in_source(splicer, import_map, collection, spec, namespace, args, options)
+                    unit_test_deps += rewrite_unit_tests_patch_in_source(splicer, collection, spec, namespace, args, options)
+                    normalize_implicit_relative_imports_in_source(splicer, file_path)
+            except UnsupportedSourceLayout as err:
+                logger.info('Falling back to RedBaron for %s: %s', file_path, err)
+            else:
+                rewrite_paths['splice'] += 1
+                deps += unit_test_deps
+                continue
+
+        rewrite_paths['fst'] += 1
         with fst_rewrite_session(file_path, file_path) as unit_test_module_fst:
             deps += rewrite_imports(unit_test_module_fst, collection, spec, namespace, args, options)
             deps += rewrite_unit_tests_patch(unit_test_module_fst, collection, spec, namespace, args, options)
@@ -1778,8 +3015,16 @@ def add_deps_to_metadata(deps, galaxy_metadata):
         galaxy_metadata['dependencies'][dep] = '>=%s' % DEFAULT_VERSION
 
 
-def publish_to_github(collections_target_dir, spec, github_api, rsa_key):
-    """Push all migrated collections to their Git remotes."""
+def publish_to_github(collections_target_dir, spec, github_api, ssh_keys, jobs=1, auth='deploy-key'):
+    """Push all migrated collections to their Git remotes.
+
+    GitHub only lets a public key be a deploy key of one repo at a
+    time, so each key pushes one collection at a time and as many
+    collections are published concurrently as there are keys. With
+    the ``app-token`` auth, up to ``jobs`` collections are pushed
+    concurrently over HTTPS using the GitHub App installation token
+    and the keys are not used.
+    """
     collections_base_dir = os.path.join(collections_target_dir, 'collections')
     collections_root_dir = os.path.join(
         collections_base_dir,
@@ -1791,34 +3036,115 @@ def publish_to_github(collections_target_dir, spec, github_api, rsa_key):
         for coll in ns_val.keys()
         if not coll.startswith('_')
     )
-    logger.debug('Using SSH key %s...', rsa_key.public_openssh)
-    with rsa_key.ssh_agent as ssh_agent:
-        for collection_dir, repo_name in collection_paths_except_core:
-            galaxy_yml = read_yaml_file(os.path.join(collection_dir, 'galaxy.yml'))
-            git_repo_url = galaxy_yml['repository']
-            coll_home_url = galaxy_yml['repository']
-            git_repo_url_repr = '...'.join((
-                git_repo_url[:5], git_repo_url[-5:],
-            )) if not git_repo_url.startswith('git@') else git_repo_url
-            logger.info(
-                'Forcefully pushing the migrated collection `%s` '
-                'to GitHub org `%s` using `%s` Git URL for push',
-                repo_name,
-                github_api.github_org_name,
-                git_repo_url_repr,
+    if auth == 'app-token':
+        push_slots = [(None, NoSSHAgent())] * jobs
+    else:
+        # the agents are started by the pushes taking the slots
+        push_slots = [(ssh_key, None) for ssh_key in ssh_keys]
+    with contextlib.ExitStack() as ssh_agents_stack:
+        asyncio.run(publish_collections(
+            collection_paths_except_core, github_api, push_slots, auth,
+            ssh_agents_stack,
+        ))
+
+
+async def publish_collections(collection_paths, github_api, push_slots, auth, ssh_agents_stack):
+    """Publish the collections sharing one HTTP session.
+
+    All the repos are provisioned before any push starts. Each push
+    takes one of the ``(SSH key, SSH agent)`` slots for its
+    duration. The key of a slot is only generated and its agent is
+    only started, within the ``ssh_agents_stack``, when the slot is
+    first taken. Waits for all the pushes to finish, so that every
+    temporary deploy key gets removed, before raising the first
+    failure. Then, even if provisioning failed, sweeps the temporary
+    keys left in the repos by earlier crashed runs and revokes the
+    installation token used by the ``app-token`` pushes.
+    """
+    collection_paths = list(collection_paths)
+    repo_names = [repo_name for _, repo_name in collection_paths]
+    free_push_slots = asyncio.Queue()
+    for push_slot in push_slots:
+        free_push_slots.put_nowait(push_slot)
+    async with ClientSession() as http_session:
+        try:
+            with run_timer.phase('provision_repos'):
+                await github_api.provision_repos(
+                    repo_names, jobs=len(push_slots), http_session=http_session,
+                )
+            results = await asyncio.gather(
+                *(
+                    publish_collection(
+                        collection_dir, repo_name,
+                        github_api, http_session, free_push_slots, auth,
+                        ssh_agents_stack,
+                    )
+                    for collection_dir, repo_name in collection_paths
+                ),
+                return_exceptions=True,
             )
-            git_force_push_cmd = (
-                'git', 'push', '--force', git_repo_url, 'HEAD:master',
+        finally:
+            await github_api.sweep_stale_deploy_keys(
+                repo_names, jobs=len(push_slots), http_session=http_session,
             )
-            with github_api.tmp_deployment_key_for(repo_name):
-                ensure_cmd_succeeded(
-                    ssh_agent, git_force_push_cmd, collection_dir,
+            if auth == 'app-token':
+                await github_api.revoke_installation_token(
+                    http_session=http_session,
                 )
-            logger.info(
-                'The migrated collection has been successfully published to '
-                '`%s` GitHub repository...',
-                coll_home_url,
-            )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def publish_collection(collection_dir, repo_name, github_api, http_session, free_push_slots, auth, ssh_agents_stack):
+    """Push the collection using a temporary deploy key or the app token."""
+    galaxy_yml = read_yaml_file(os.path.join(collection_dir, 'galaxy.yml'))
+    git_repo_url = galaxy_yml['repository']
+    coll_home_url = galaxy_yml['repository']
+    git_repo_url_repr = '...'.join((
+        git_repo_url[:5], git_repo_url[-5:],
+    )) if not git_repo_url.startswith('git@') else git_repo_url
+    git_force_push_cmd = (
+        'git', 'push', '--force', git_repo_url, 'HEAD:master',
+    )
+    deployment_ssh_key, ssh_agent = await free_push_slots.get()
+    try:
+        if ssh_agent is None:
+            ssh_agent = ssh_agents_stack.enter_context(deployment_ssh_key.ssh_agent)
+        logger.info(
+            'Forcefully pushing the migrated collection `%s` '
+            'to GitHub org `%s` using `%s` Git URL for push',
+            repo_name,
+            github_api.github_org_name,
+            git_repo_url_repr,
+        )
+        with run_timer.phase('publish', key=repo_name):
+            if auth == 'app-token':
+                git_token_url = await github_api.get_git_repo_token(
+                    repo_name, http_session=http_session,
+                )
+                await ensure_cmd_succeeded_async(
+                    ssh_agent,
+                    ('git', 'push', '--force', git_token_url, 'HEAD:master'),
+                    collection_dir,
+                    cmd_repr=git_force_push_cmd,
+                )
+            else:
+                async with github_api.async_tmp_deployment_key_for(
+                        repo_name,
+                        deployment_ssh_key=deployment_ssh_key,
+                        http_session=http_session,
+                ):
+                    await ensure_cmd_succeeded_async(
+                        ssh_agent, git_force_push_cmd, collection_dir,
+                    )
+    finally:
+        free_push_slots.put_nowait((deployment_ssh_key, ssh_agent))
+    logger.info(
+        'The migrated collection has been successfully published to '
+        '`%s` GitHub repository...',
+        coll_home_url,
+    )
 
 
 def push_migrated_core(devel_path, github_api, rsa_key, spec_dir):
@@ -1838,7 +3164,8 @@ def push_migrated_core(devel_path, github_api, rsa_key, spec_dir):
             migrated_devel_repo_name,
     ):
         # NOTE: assumes the repo is not used and/or is locked while migration is running
-        ensure_cmd_succeeded(ssh_agent, git_force_push_cmd, devel_path)
+        with run_timer.phase('publish', key=migrated_devel_repo_name):
+            ensure_cmd_succeeded(ssh_agent, git_force_push_cmd, devel_path)
 
 
 def assert_migrating_git_tracked_resources(migrated_to_collection: Union[Iterable[str], Dict[str, Any]]):
@@ -1898,11 +3225,15 @@ def mark_moved_resources(checkout_dir, namespace, collection, migrated_to_collec
 
         migrated_secion['migrated_to'] = migrated_to
 
-    write_yaml_into_file_as_is(botmeta_checkout_path, botmeta)
+    botmeta_text = write_yaml_into_file_as_is(botmeta_checkout_path, botmeta)
 
-    # Commit changes to the migrated Git repo
-    subprocess.check_call(('git', 'add', f'{botmeta_rel_path!s}'), cwd=checkout_dir)
-    subprocess.check_call(('git', 'commit', '-m', f'Mark migrated {collection}', '--allow-empty'), cwd=checkout_dir)
+    # Commit changes to the migrated Git repo, skipping the index refresh of "git commit"
+    parent = git_rev_parse_head(checkout_dir)
+    commit = commit_index_changes(
+        checkout_dir, parent, f'Mark migrated {collection}',
+        new_contents={botmeta_rel_path: botmeta_text},
+    )
+    subprocess.check_call(('git', 'update-ref', 'HEAD', commit, parent), cwd=checkout_dir)
 
 
 ### Rewrite integration tests
@@ -1919,6 +3250,7 @@ def integration_tests_add_to_deps(collection, dep_collection):
         logger.info("Adding %s.%s as a dep for %s.%s", dep_collection[0], dep_collection[1], collection[0], collection[1])
 
     integration_tests_deps.add(dep_collection)
+    record_rewrite_side_effect('integration_tests_add_to_deps', collection, dep_collection)
 
 
 def discover_integration_tests(checkout_dir, plugin_type, plugin_name):
@@ -1941,12 +3273,12 @@ def discover_integration_tests(checkout_dir, plugin_type, plugin_name):
     # see process_integration_tests_deps and actually_remove functions
     files = [(filename, True) for filename in integration_tests_files]
 
-    deps = []
+    deps = {}
     for fname, dummy_to_remove in files:
         logger.info('Found integration tests for %s %s in %s', plugin_type, plugin_name, fname)
-        deps.extend(process_integration_tests_deps(checkout_dir, fname))
+        deps.update(dict.fromkeys(process_integration_tests_deps(checkout_dir, fname)))
 
-    return files + deps
+    return files + list(deps)
 
 
 @functools.lru_cache()
@@ -1979,8 +3311,14 @@ def get_processed_aliases(checkout_dir):
     return res
 
 
-def process_integration_tests_deps(checkout_dir, target_dir, log=True):
+def read_integration_target_direct_deps(checkout_dir, target_dir, aliases):
+    """Return the targets a target directly depends on.
+
+    Those come from the meta dependencies, the ``needs/target``
+    and ``setup`` aliases and the symlinks into other targets.
+    """
     deps = []
+    targets_dir = os.path.join(checkout_dir, 'test/integration/targets')
 
     dep_files = [os.path.join(target_dir, 'meta', 'main.yml'), os.path.join(target_dir, 'meta', 'main.yaml')]
     for dep_file in dep_files:
@@ -1991,26 +3329,16 @@ def process_integration_tests_deps(checkout_dir, target_dir, log=True):
                 for dep in meta_deps:
                     if isinstance(dep, dict):
                         dep = dep.get('role')
-                    dep_fname = os.path.join(checkout_dir, 'test/integration/targets', dep)
-                    if log:
-                        logger.info('Adding integration tests dependency target %s for %s', dep_fname, target_dir)
-                    deps.append((dep_fname, False))
-                    deps.extend(process_integration_tests_deps(checkout_dir, dep_fname, log=log))
+                    deps.append(os.path.join(targets_dir, dep))
             break
 
-    aliases_file = os.path.join(target_dir, 'aliases')
-    if os.path.exists(aliases_file):
-        content = read_text_from_file(aliases_file)
-        for alias in content.split('\n'):
-            if not alias.startswith(('needs/target/', 'setup/once/', 'setup/always/')):
-                continue
-            dep = alias.split('/')[-1]
-            dep_fname = os.path.join(checkout_dir, 'test/integration/targets', dep)
-            if os.path.exists(dep_fname):
-                if log:
-                    logger.info('Adding integration tests dependency target %s for %s', dep_fname, target_dir)
-                deps.append((dep_fname, False))
-                deps.extend(process_integration_tests_deps(checkout_dir, dep_fname, log=log))
+    for alias in aliases:
+        if not alias.startswith(('needs/target/', 'setup/once/', 'setup/always/')):
+            continue
+        dep = alias.split('/')[-1]
+        dep_fname = os.path.join(targets_dir, dep)
+        if os.path.exists(dep_fname):
+            deps.append(dep_fname)
 
     for dirpath, dirnames, filenames in os.walk(target_dir):
         for filename in filenames:
@@ -2020,12 +3348,143 @@ def process_integration_tests_deps(checkout_dir, target_dir, log=True):
                 parts = real_path.split('/')
                 index = parts.index('targets')
                 dep = parts[index+1]
-                dep_fname = os.path.join(checkout_dir, 'test/integration/targets', dep)
+                dep_fname = os.path.join(targets_dir, dep)
                 if os.path.exists(dep_fname):
-                    if log:
-                        logger.info('Adding integration tests dependency target %s for %s', dep_fname, target_dir)
-                    deps.append((dep_fname, False))
-                    deps.extend(process_integration_tests_deps(checkout_dir, dep_fname, log=log))
+                    deps.append(dep_fname)
+
+    return deps
+
+
+class IntegrationTargetsGraph:
+    """Dependency graph of the integration test targets in a checkout.
+
+    Every target is read once, the transitive dependencies are
+    computed once per strongly connected component so the cycles
+    are tolerated and the lookups are memoized.
+    """
+
+    def __init__(self, checkout_dir):
+        targets_dir = os.path.join(checkout_dir, 'test/integration/targets')
+        self.deps = {}
+        self.helpers = set()
+        self.targets = []
+        for target in sorted(os.listdir(targets_dir)):
+            target_dir = os.path.join(targets_dir, target)
+            if not os.path.isdir(target_dir):
+                continue
+            aliases_file = os.path.join(target_dir, 'aliases')
+            aliases = read_text_from_file(aliases_file).split('\n') if os.path.exists(aliases_file) else []
+            if target.startswith(('setup_', 'prepare_')) or any(alias.strip() == 'hidden' for alias in aliases):
+                self.helpers.add(target_dir)
+            self.targets.append(target_dir)
+            self.deps[target_dir] = read_integration_target_direct_deps(checkout_dir, target_dir, aliases)
+        # meta dependencies are not checked for existence
+        for target_deps in list(self.deps.values()):
+            for dep in target_deps:
+                self.deps.setdefault(dep, [])
+
+        self._closures = {}
+        for component in self._strongly_connected_components():
+            self._memoize_closure(component)
+
+    def _strongly_connected_components(self):
+        """Yield the graph components, dependencies first (Tarjan)."""
+        indices = {}
+        lowlinks = {}
+        stack = []
+        on_stack = set()
+
+        for root in self.deps:
+            if root in indices:
+                continue
+            indices[root] = lowlinks[root] = len(indices)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.deps[root]))]
+            while work:
+                node, dep_iter = work[-1]
+                for dep in dep_iter:
+                    if dep not in indices:
+                        indices[dep] = lowlinks[dep] = len(indices)
+                        stack.append(dep)
+                        on_stack.add(dep)
+                        work.append((dep, iter(self.deps[dep])))
+                        break
+                    if dep in on_stack:
+                        lowlinks[node] = min(lowlinks[node], indices[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlinks[parent] = min(lowlinks[parent], lowlinks[node])
+                    if lowlinks[node] == indices[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        yield component[::-1]
+
+    def _memoize_closure(self, component):
+        members = set(component)
+        if len(component) > 1 or component[0] in self.deps[component[0]]:
+            logger.warning('Integration tests targets depend on each other in a cycle: %s', ', '.join(component))
+
+        # NOTE: dict as an ordered set, the order is the DFS pre-order
+        closure = {}
+        for member in component:
+            for dep in self.deps[member]:
+                closure[dep] = None
+                if dep not in members:
+                    closure.update(dict.fromkeys(self._closures[dep]))
+        closure = tuple(closure)
+        for member in component:
+            self._closures[member] = closure
+
+    def get_deps(self, target_dir):
+        """Return all the targets the target depends on."""
+        return self._closures.get(target_dir, ())
+
+    def get_unused_helpers(self):
+        """Return the setup and hidden targets only used by other unused helpers.
+
+        Reference counting over the reverse direct dependencies,
+        a helper is unused once all of its users are unused helpers.
+        The targets in dependency cycles are never unused.
+        """
+        users_left = dict.fromkeys(self.helpers, 0)
+        used_helpers = defaultdict(set)
+        for target_dir in self.targets:
+            for dep in set(self.deps[target_dir]) & self.helpers:
+                users_left[dep] += 1
+                used_helpers[target_dir].add(dep)
+
+        unused = set()
+        worklist = [helper for helper, users in users_left.items() if not users]
+        while worklist:
+            helper = worklist.pop()
+            unused.add(helper)
+            for dep in used_helpers[helper]:
+                users_left[dep] -= 1
+                if not users_left[dep]:
+                    worklist.append(dep)
+
+        return unused
+
+
+@functools.lru_cache()
+def get_integration_targets_graph(checkout_dir):
+    return IntegrationTargetsGraph(checkout_dir)
+
+
+def process_integration_tests_deps(checkout_dir, target_dir, log=True):
+    deps = []
+    for dep_fname in get_integration_targets_graph(checkout_dir).get_deps(target_dir):
+        if log:
+            logger.info('Adding integration tests dependency target %s for %s', dep_fname, target_dir)
+        deps.append((dep_fname, False))
 
     return deps
 
@@ -2069,7 +3528,7 @@ def rewrite_integration_tests(test_dirs, checkout_dir, collection_dir, namespace
                         integration_tests_add_to_deps((namespace, collection), (dep_ns, dep_coll))
                 elif ext in ('.ps1',):
                     # FIXME
-                    shutil.copy2(src, dest)
+                    materialize_file(src, dest, args.link_mode, shutil.copy2)
                 elif ext in ('.yml', '.yaml'):
                     rewrite_yaml(src, dest, namespace, collection, spec, args, checkout_dir)
                 elif ext in ('.sh',):
@@ -2077,7 +3536,7 @@ def rewrite_integration_tests(test_dirs, checkout_dir, collection_dir, namespace
                 elif filename == 'ansible.cfg':
                     rewrite_ini(src, dest, namespace, collection, spec, args)
                 else:
-                    shutil.copy2(src, dest)
+                    materialize_file(src, dest, args.link_mode, shutil.copy2)
 
                 if to_remove:
                     remove(src, namespace, collection)
@@ -2089,43 +3548,45 @@ def rewrite_integration_tests(test_dirs, checkout_dir, collection_dir, namespace
     return migrated
 
 
+@cached_rewrite()
 def rewrite_sh(src, dest, namespace, collection, spec, args):
-    sh_key_map = {
-        'ANSIBLE_CACHE_PLUGIN': 'cache',
-        'ANSIBLE_CALLBACK_WHITELIST': 'callback',
-        'ANSIBLE_INVENTORY_CACHE_PLUGIN': 'cache',
-        'ANSIBLE_STDOUT_CALLBACK': 'callback',
-        'ANSIBLE_STRATEGY': 'strategy',
-        '--become-method': 'become',
-        '-c': 'connection',
-        '--connection': 'connection',
-    }
+    """Rewrite the plugin names passed via env vars and CLI options in a shell script.
+
+    Return the ``(old, new)`` pairs of the rewritten references,
+    those are also added to the manual check list.
+    """
+    sh_rewrite_re, plugin_fqcns = get_sh_plugin_rewrite_matcher(spec)
+    replacements = []
+
+    def rewrite_match(match):
+        plugin_type = match.lastgroup
+        plugin_name = match.group(plugin_type)
+        ns, coll = plugin_fqcns[plugin_type][plugin_name]
+        new_plugin_name = get_plugin_fqcn(ns, coll, plugin_name)
+        msg = 'Rewriting to %s' % new_plugin_name
+        if args.fail_on_core_rewrite:
+            raise RuntimeError(msg)
+
+        logger.debug(msg)
+        integration_tests_add_to_deps((namespace, collection), (ns, coll))
+        old_ref = match.group(0)
+        new_ref = old_ref[:-len(plugin_name)] + new_plugin_name
+        replacements.append((old_ref, new_ref))
+        return new_ref
 
     contents = read_text_from_file(src)
-    for key, plugin_type in sh_key_map.items():
-        if contents.find(key) == -1:
-            continue
-        for ns in spec.keys():
-            for coll in get_rewritable_collections(ns, spec):
-                plugins = get_plugins_from_collection(ns, coll, plugin_type, spec)
-                for plugin_name in plugins:
-                    if contents.find(plugin_name) == -1:
-                        continue
-                    # FIXME list
-                    new_plugin_name = get_plugin_fqcn(ns, coll, plugin_name)
-                    msg = 'Rewriting to %s' % new_plugin_name
-                    if args.fail_on_core_rewrite:
-                        raise RuntimeError(msg)
-
-                    logger.debug(msg)
-                    contents = contents.replace(key + '=' + plugin_name, key + '=' + new_plugin_name)
-                    contents = contents.replace(key + ' ' + plugin_name, key + ' ' + new_plugin_name)
-                    integration_tests_add_to_deps((namespace, collection), (ns, coll))
+    if sh_rewrite_re is not None:
+        contents = sh_rewrite_re.sub(rewrite_match, contents)
+
+    for old_ref, new_ref in replacements:
+        add_manual_check(old_ref, new_ref, dest)
 
     write_text_into_file(dest, contents)
     shutil.copystat(src, dest)
+    return replacements
 
 
+@cached_rewrite()
 def rewrite_ini(src, dest, namespace, collection, spec, args):
     ini_key_map = {
         'defaults': {
@@ -2148,6 +3609,7 @@ def rewrite_ini(src, dest, namespace, collection, spec, args):
         except KeyError:
             continue
 
+    unshare_file(dest)
     with open(dest, 'w') as cf:
         config.write(cf)
 
@@ -2180,7 +3642,20 @@ def rewrite_ini_section(config, key_map, section, namespace, collection, spec, a
         config.set(section, keyword, ','.join(new_plugin_names))
 
 
+def get_jinja_plugin_maps_digest(call_args):
+    """Return the hash of the filter/test maps YAML rewrites depend on."""
+    return repr([
+        sorted(get_jinja_plugin_map(plugin_type, call_args['spec'], call_args['checkout_dir'], call_args['args'].vardir).items())
+        for plugin_type in sorted(JINJA_PLUGIN_CLASSES)
+    ])
+
+
+@cached_rewrite(get_jinja_plugin_maps_digest)
 def rewrite_yaml(src, dest, namespace, collection, spec, args, checkout_dir):
+    if args.yaml_rewrite_mode == 'patch':
+        rewrite_yaml_in_place(src, dest, namespace, collection, spec, args, checkout_dir)
+        return
+
     contents = read_ansible_yaml_file(src)
     contents_orig = deepcopy(contents)
 
@@ -2188,11 +3663,171 @@ def rewrite_yaml(src, dest, namespace, collection, spec, args, checkout_dir):
 
     # if there are no changes than just copy the file to preserve YAML formatting
     if contents == contents_orig:
-        shutil.copy2(src, dest)
+        materialize_file(src, dest, args.link_mode, shutil.copy2)
     else:
         write_ansible_yaml_into_file_as_is(dest, contents)
 
 
+def rewrite_yaml_in_place(src, dest, namespace, collection, spec, args, checkout_dir):
+    """Rewrite the YAML file by patching the changed scalars in its source text.
+
+    Falls back to dumping the whole document when a change cannot
+    be mapped back onto the source text.
+    """
+    text, node, contents, constructed_objects = read_ansible_yaml_file_nodes(src)
+
+    _rewrite_yaml(contents, namespace, collection, spec, args, dest, checkout_dir)
+
+    patches = collect_yaml_scalar_patches(text, constructed_objects)
+    if patches is not None and not patches:
+        materialize_file(src, dest, args.link_mode, shutil.copy2)
+        return
+
+    if patches is not None:
+        patched_text = apply_text_patches(text, patches)
+        patched_contents = AnsibleLoader(patched_text, file_name=src).get_single_data()
+        if yaml_data_matches(patched_contents, contents):
+            write_text_into_file(dest, patched_text)
+            return
+
+    logger.debug('Could not patch %s in place, dumping the rewritten document instead', src)
+    write_ansible_yaml_into_file_as_is(dest, contents)
+
+
+def collect_yaml_scalar_patches(text, constructed_objects):
+    """Find the scalars changed by the rewrite in the constructed data.
+
+    Compares every slot of the constructed mappings and sequences
+    with the objects originally constructed from their nodes.
+    Returns a ``{(start, end): replacement}`` dict of the source text
+    patches or ``None`` if some change cannot be located.
+    """
+    original_ids = {id(obj) for obj in constructed_objects.values()}
+    patches = {}
+
+    def is_rewritten(value, orig):
+        return isinstance(value, str) and value is not orig and id(value) not in original_ids and value != orig
+
+    def add_patch(scalar_node, new_value):
+        if scalar_node.tag != 'tag:yaml.org,2002:str':
+            # not a string in the source, e.g. mode: 0755 converted by the rewrite
+            return True
+        replacement = get_yaml_scalar_replacement(text, scalar_node, new_value)
+        if replacement is None:
+            return False
+        span = scalar_node.start_mark.index, scalar_node.end_mark.index
+        return patches.setdefault(span, replacement) == replacement
+
+    for node, obj in constructed_objects.items():
+        if isinstance(node, yaml.SequenceNode):
+            if not isinstance(obj, list) or len(obj) != len(node.value):
+                return None
+            for item_node, item in zip(node.value, obj):
+                if is_rewritten(item, constructed_objects.get(item_node)):
+                    if not isinstance(item_node, yaml.ScalarNode) or not add_patch(item_node, item):
+                        return None
+        elif isinstance(node, yaml.MappingNode):
+            if not isinstance(obj, Mapping):
+                return None
+            orig_keys = {constructed_objects.get(key_node) for key_node, _ in node.value}
+            for key_node, value_node in node.value:
+                key = constructed_objects.get(key_node)
+                if key not in obj:
+                    key = find_renamed_yaml_key(key, obj, orig_keys)
+                    if key is None or not add_patch(key_node, key):
+                        return None
+                if is_rewritten(obj[key], constructed_objects.get(value_node)):
+                    if not isinstance(value_node, yaml.ScalarNode) or not add_patch(value_node, obj[key]):
+                        return None
+
+    return patches
+
+
+def find_renamed_yaml_key(old_key, mapping, orig_keys):
+    """Find the FQCN key a module or ``with_`` lookup key was renamed to."""
+    if not isinstance(old_key, str):
+        return None
+    candidates = []
+    for key in mapping:
+        if not isinstance(key, str) or key in orig_keys:
+            continue
+        name = key.rpartition('.')[-1]
+        if name == old_key or (old_key.startswith('with_') and key.startswith('with_') and name == old_key[len('with_'):]):
+            candidates.append(key)
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def get_yaml_scalar_replacement(text, node, new_value):
+    """Render the new value of the scalar node in its source style.
+
+    Only plain, quoted and literal block scalars whose source text
+    can be matched against their value are supported.
+    """
+    source = text[node.start_mark.index:node.end_mark.index]
+    old_value = node.value
+
+    if not node.style:  # plain scalars have no style in PyYAML and an empty one in libyaml
+        if source == old_value and '\n' not in new_value:
+            return new_value
+    elif node.style == "'":
+        if source == "'%s'" % old_value.replace("'", "''") and '\n' not in new_value:
+            return "'%s'" % new_value.replace("'", "''")
+    elif node.style == '"':
+        if source == '"%s"' % old_value and not any(char in old_value + new_value for char in '"\\\n'):
+            return '"%s"' % new_value
+    elif node.style == '|':
+        return get_yaml_literal_block_replacement(source, old_value, new_value)
+
+    return None
+
+
+def get_yaml_literal_block_replacement(source, old_value, new_value):
+    """Patch the changed lines of a literal block scalar."""
+    old_lines = old_value.split('\n')
+    new_lines = new_value.split('\n')
+    header, _, body = source.partition('\n')
+    body_lines = body.split('\n')
+    if len(old_lines) != len(new_lines) or len(old_lines) > len(body_lines):
+        return None
+
+    for idx, (old_line, new_line) in enumerate(zip(old_lines, new_lines)):
+        if old_line == new_line:
+            continue
+        indent = body_lines[idx][:len(body_lines[idx]) - len(old_line)]
+        if indent.strip(' ') or indent + old_line != body_lines[idx]:
+            return None
+        body_lines[idx] = indent + new_line
+
+    return header + '\n' + '\n'.join(body_lines)
+
+
+def apply_text_patches(text, patches):
+    """Replace the ``(start, end)`` spans of the text."""
+    chunks = []
+    pos = 0
+    for (start, end), replacement in sorted(patches.items()):
+        if start < pos:
+            raise ValueError('Overlapping text patches at %d' % start)
+        chunks.extend((text[pos:start], replacement))
+        pos = end
+    chunks.append(text[pos:])
+    return ''.join(chunks)
+
+
+def yaml_data_matches(parsed, rewritten):
+    """Compare the re-parsed patched document with the rewritten data.
+
+    Modes rewritten to octal strings match their integer values.
+    """
+    if isinstance(parsed, Mapping) and isinstance(rewritten, Mapping):
+        return parsed.keys() == rewritten.keys() and all(yaml_data_matches(parsed[key], rewritten[key]) for key in parsed)
+    if isinstance(parsed, list) and isinstance(rewritten, list):
+        return len(parsed) == len(rewritten) and all(map(yaml_data_matches, parsed, rewritten))
+    if isinstance(parsed, int) and not isinstance(parsed, bool) and isinstance(rewritten, str):
+        return rewritten == '0' + '%o' % parsed
+    return parsed == rewritten
+
+
 def _rewrite_yaml(contents, namespace, collection, spec, args, dest, checkout_dir):
     if isinstance(contents, list):
         for el in contents:
@@ -2219,23 +3854,19 @@ def _rewrite_yaml_mapping_keys_non_vars(el, namespace, collection, spec, args, d
             module_name = None
 
         if module_name:
-            for ns in spec.keys():
-                for coll in get_rewritable_collections(ns, spec):
-                    if collection == coll:
-                        # https://github.com/ansible-community/collection_migration/issues/156
-                        continue
-
-                    if module_name not in get_plugins_from_collection(ns, coll, 'modules', spec):
-                        continue
+            for ns, coll in get_plugin_collections_by_name(module_name, 'modules', spec):
+                if collection == coll:
+                    # https://github.com/ansible-community/collection_migration/issues/156
+                    continue
 
-                    new_module_name = get_plugin_fqcn(ns, coll, module_name)
-                    msg = 'Rewriting to %s' % new_module_name
-                    if args.fail_on_core_rewrite:
-                        raise RuntimeError(msg)
+                new_module_name = get_plugin_fqcn(ns, coll, module_name)
+                msg = 'Rewriting to %s' % new_module_name
+                if args.fail_on_core_rewrite:
+                    raise RuntimeError(msg)
 
-                    logger.debug(msg)
-                    translate.append((new_module_name, module_name))
-                    integration_tests_add_to_deps((namespace, collection), (ns, coll))
+                logger.debug(msg)
+                translate.append((new_module_name, module_name))
+                integration_tests_add_to_deps((namespace, collection), (ns, coll))
 
     for key in el.keys():
         if key not in KEYWORDS_TO_PLUGIN_MAP and is_reserved_name(key):
@@ -2317,17 +3948,15 @@ def _rewrite_yaml_mapping_values(el, namespace, collection, spec, args, dest, ch
                 if isinstance(item, Mapping):
                     _rewrite_yaml_mapping(el[key][idx], namespace, collection, spec, args, dest, checkout_dir)
                 else:
-                    if key == 'module_blacklist':
-                        for ns in spec.keys():
-                            for coll in get_rewritable_collections(ns, spec):
-                                if item in get_plugins_from_collection(ns, coll, 'modules', spec):
-                                    new_plugin_name = get_plugin_fqcn(ns, coll, el[key][idx])
-                                    msg = 'Rewriting to %s' % new_plugin_name
-                                    if args.fail_on_core_rewrite:
-                                        raise RuntimeError(msg)
-                                    logger.debug(msg)
-                                    el[key][idx] = new_plugin_name
-                                    integration_tests_add_to_deps((namespace, collection), (ns, coll))
+                    if key == 'module_blacklist' and isinstance(item, str):
+                        for ns, coll in get_plugin_collections_by_name(item, 'modules', spec):
+                            new_plugin_name = get_plugin_fqcn(ns, coll, el[key][idx])
+                            msg = 'Rewriting to %s' % new_plugin_name
+                            if args.fail_on_core_rewrite:
+                                raise RuntimeError(msg)
+                            logger.debug(msg)
+                            el[key][idx] = new_plugin_name
+                            integration_tests_add_to_deps((namespace, collection), (ns, coll))
                     if isinstance(el[key][idx], str):
                         el[key][idx] = _rewrite_yaml_lookup(el[key][idx], namespace, collection, spec, args)
                         el[key][idx] = _rewrite_yaml_filter(el[key][idx], namespace, collection, spec, args, checkout_dir)
@@ -2342,21 +3971,34 @@ def _rewrite_yaml_lookup(value, namespace, collection, spec, args):
     if not ('lookup(' in value or 'query(' in value or 'q(' in value):
         return value
 
-    for ns in spec.keys():
-        for coll in get_rewritable_collections(ns, spec):
-            for plugin_name in get_plugins_from_collection(ns, coll, 'lookup', spec):
-                if plugin_name not in value:
-                    continue
-                new_plugin_name = get_plugin_fqcn(ns, coll, plugin_name)
-                msg = 'Rewriting to %s' % new_plugin_name
-                if args.fail_on_core_rewrite:
-                    raise RuntimeError(msg)
+    lookup_colls = get_lookup_plugin_collections(spec)
 
-                logger.debug(msg)
-                value = value.replace(plugin_name, new_plugin_name)
-                integration_tests_add_to_deps((namespace, collection), (ns, coll))
+    def rewrite_lookup_call(match):
+        plugin_name = match.group('name')
+        if plugin_name not in lookup_colls:
+            return match.group(0)
+
+        ns, coll = lookup_colls[plugin_name]
+        new_plugin_name = get_plugin_fqcn(ns, coll, plugin_name)
+        msg = 'Rewriting to %s' % new_plugin_name
+        if args.fail_on_core_rewrite:
+            raise RuntimeError(msg)
+
+        logger.debug(msg)
+        integration_tests_add_to_deps((namespace, collection), (ns, coll))
+        return '%s%s%s' % (match.group('call'), new_plugin_name, match.group('quote'))
+
+    return JINJA_LOOKUP_CALL_RE.sub(rewrite_lookup_call, value)
 
-    return value
+
+def get_lookup_plugin_collections(spec):
+    """Map rewritable lookup names to the first ``(namespace, collection)`` having them."""
+    plugin_index = get_plugin_index(spec)
+    if 'lookup_colls' not in plugin_index:
+        lookup_colls = plugin_index['lookup_colls'] = {}
+        for ns, coll, plugin_name in get_rewritable_plugins_of_type('lookup', spec):
+            lookup_colls.setdefault(plugin_name, (ns, coll))
+    return plugin_index['lookup_colls']
 
 
 def get_python_module(module_name, module_locations):
@@ -2374,33 +4016,84 @@ def get_python_module(module_name, module_locations):
     return imported_module
 
 
+def get_jinja_plugin_names(plugin_type, module_name, module_locations, names_cache):
+    """Return the names of Jinja2 filters/tests provided by a plugin file.
+
+    The names are looked up in ``names_cache`` by the git blob SHA
+    of the plugin source and only get imported on a cache miss.
+    """
+    for module_location in module_locations:
+        try:
+            blob_sha = git_blob_sha(module_location)
+        except FileNotFoundError:
+            continue
+        break
+    else:
+        raise FileNotFoundError(','.join(module_locations))
+
+    if blob_sha not in names_cache:
+        class_name, method_name = JINJA_PLUGIN_CLASSES[plugin_type]
+        plugin_cls = getattr(get_python_module(module_name, [module_location]), class_name, None)
+        names_cache[blob_sha] = [] if plugin_cls is None else sorted(getattr(plugin_cls(), method_name)().keys())
+
+    return names_cache[blob_sha]
+
+
+def get_jinja_plugin_map(plugin_type, spec, checkout_dir, vardir):
+    """Return a map of Jinja2 filter/test names to their collections.
+
+    It is built once per spec on first use, before forking the pool
+    workers so they inherit it. The names each plugin file provides
+    are persisted in the var dir between the runs.
+    """
+    if plugin_type in JINJA_PLUGIN_MAPS:
+        return JINJA_PLUGIN_MAPS[plugin_type]
+
+    cache_file = os.path.join(vardir, f'jinja-{plugin_type}-names.yml')
+    try:
+        names_cache = read_yaml_file(cache_file) or {}
+    except (FileNotFoundError, yaml.YAMLError):
+        # a missing or corrupted cache only costs rebuilding it
+        names_cache = {}
+    cache_size = len(names_cache)
+
+    jinja_plugin_map = {}
+    for ns, coll, plugin_name in get_rewritable_plugins_of_type(plugin_type, spec):
+        module_name = f'ansible.plugins.{plugin_type}.{plugin_name}'
+        module_locations = [
+            os.path.join(checkout_dir, f'lib/ansible/plugins/{plugin_type}/{plugin_name}.py'),
+            os.path.join(vardir, 'collections/ansible_collections/', ns, coll, f'plugins/{plugin_type}/{plugin_name}.py'),
+        ]
+        for jinja_name in get_jinja_plugin_names(plugin_type, module_name, module_locations, names_cache):
+            jinja_plugin_map.setdefault(jinja_name, (ns, coll))
+
+    if len(names_cache) != cache_size:
+        # concurrent runs sharing the var dir may write it too, make it atomic
+        tmp_cache_file = f'{cache_file}.{os.getpid()}.tmp'
+        write_yaml_into_file_as_is(tmp_cache_file, names_cache)
+        os.replace(tmp_cache_file, cache_file)
+
+    JINJA_PLUGIN_MAPS[plugin_type] = jinja_plugin_map
+    return jinja_plugin_map
+
+
 def _rewrite_yaml_filter(value, namespace, collection, spec, args, checkout_dir):
     if '|' not in value:
         return value
-    for ns in spec.keys():
-        for coll in get_rewritable_collections(ns, spec):
-            for filter_plugin_name in get_plugins_from_collection(ns, coll, 'filter', spec):
-                module_name = f'ansible.plugins.filter.{filter_plugin_name}'
-                module_locations = [
-                    os.path.join(checkout_dir, f'lib/ansible/plugins/filter/{filter_plugin_name}.py'),
-                    os.path.join(VARDIR, 'collections/ansible_collections/', ns, coll, f'plugins/filter/{filter_plugin_name}.py'),
-                ]
-                imported_module = get_python_module(module_name, module_locations)
-                fm = getattr(imported_module, 'FilterModule', None)
-                if fm is None:
-                    continue
-                filters = fm().filters().keys()
-                for found_filter in set(match[5] for match in FILTER_RE.findall(value)):
-                    if found_filter not in filters:
-                        continue
-                    new_plugin_name = get_plugin_fqcn(ns, coll, found_filter)
-                    msg = 'Rewriting to %s' % new_plugin_name
-                    if args.fail_on_core_rewrite:
-                        raise RuntimeError(msg)
-
-                    logger.debug(msg)
-                    value = value.replace(found_filter, new_plugin_name)
-                    integration_tests_add_to_deps((namespace, collection), (ns, coll))
+    filter_map = get_jinja_plugin_map('filter', spec, checkout_dir, args.vardir)
+    for found_filter in set(match[5] for match in FILTER_RE.findall(value)):
+        try:
+            ns, coll = filter_map[found_filter]
+        except KeyError:
+            continue
+        new_plugin_name = get_plugin_fqcn(ns, coll, found_filter)
+        msg = 'Rewriting to %s' % new_plugin_name
+        if args.fail_on_core_rewrite:
+            raise RuntimeError(msg)
+
+        logger.debug(msg)
+        value = value.replace(found_filter, new_plugin_name)
+        integration_tests_add_to_deps((namespace, collection), (ns, coll))
 
     return value
 
@@ -2408,34 +4101,32 @@ def _rewrite_yaml_filter(value, namespace, collection, spec, args, checkout_dir)
 def _rewrite_yaml_test(value, namespace, collection, spec, args, checkout_dir):
     if ' is ' not in value:
         return value
-    for ns in spec.keys():
-        for coll in get_rewritable_collections(ns, spec):
-            for test_plugin_name in get_plugins_from_collection(ns, coll, 'test', spec):
-                module_name = f'ansible.plugins.test.{test_plugin_name}'
-                module_locations = [
-                    os.path.join(checkout_dir, f'lib/ansible/plugins/test/{test_plugin_name}.py'),
-                    os.path.join(VARDIR, 'collections/ansible_collections/', ns, coll, f'plugins/test/{test_plugin_name}.py'),
-                ]
-                imported_module = get_python_module(module_name, module_locations)
-                tm = getattr(imported_module, 'TestModule', None)
-                if tm is None:
-                    continue
-                tests = tm().tests().keys()
-                for found_test in set(match[5] for match in TEST_RE.findall(value)):
-                    if found_test not in tests:
-                        continue
-                    new_plugin_name = get_plugin_fqcn(ns, coll, found_test)
-                    msg = 'Rewriting to %s' % new_plugin_name
-                    if args.fail_on_core_rewrite:
-                        raise RuntimeError(msg)
-
-                    logger.debug(msg)
-                    value = value.replace(found_test, new_plugin_name)
-                    integration_tests_add_to_deps((namespace, collection), (ns, coll))
+    test_map = get_jinja_plugin_map('test', spec, checkout_dir, args.vardir)
+    for found_test in set(match[5] for match in TEST_RE.findall(value)):
+        try:
+            ns, coll = test_map[found_test]
+        except KeyError:
+            continue
+        new_plugin_name = get_plugin_fqcn(ns, coll, found_test)
+        msg = 'Rewriting to %s' % new_plugin_name
+        if args.fail_on_core_rewrite:
+            raise RuntimeError(msg)
+
+        logger.debug(msg)
+        value = value.replace(found_test, new_plugin_name)
+        integration_tests_add_to_deps((namespace, collection), (ns, coll))
 
     return value
 
 
+def positive_int(value):
+    """Parse a CLI argument that has to be a positive integer."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
 def setup_options(parser):
     parser.add_argument('-s', '--spec', required=True, dest='spec_dir', help='A directory spec with YAML files that describe how to organize collections')
     parser.add_argument('-r', '--refresh', action='store', nargs='?', const=True, dest='refresh', default=False, help='force refreshing local Ansible checkout, optionally check out specific commitish')
@@ -2449,6 +4140,8 @@ def setup_options(parser):
     parser.add_argument('--target-github-org', action='store', type=str, dest='target_github_org', default='ansible-collection-migration', help='Push migrated collections to this GH org',)
     parser.add_argument('-P', '--publish-to-github', action='store_true', dest='publish_to_github', default=False, help='Push all migrated collections to their Git remotes')
     parser.add_argument('-m', '--move-plugins', action='store_true', dest='move_plugins', default=False, help='remove plugins from source instead of just copying them')
+    parser.add_argument('--squash-core-removals', action='store_true', dest='squash_core_removals', default=False,
+                        help='Record the removal of the migrated plugins from core in a single commit instead of one per collection')
     parser.add_argument('-M', '--push-migrated-core', action='store_true', dest='push_migrated_core', default=False, help='Push migrated core to the Git repo')
     parser.add_argument('-f', '--fail-on-core-rewrite', action='store_true', dest='fail_on_core_rewrite', default=False,
                         help='Fail on core rewrite. E.g. to verify core does not depend on the collections by running'
@@ -2459,6 +4152,37 @@ def setup_options(parser):
     parser.add_argument('--convert-symlinks', action='store_true', dest='convert_symlinks', default=False,
                         help='Convert symlinks to data copies to allow aliases to exist in different collections from original.',)
     parser.add_argument('--limit', dest='limits', action='append', help='process only matching fqns [namespace.name] or fqcns which contain this substring')
+    parser.add_argument('--no-rewrite-cache', action='store_false', dest='rewrite_cache', default=True,
+                        help='Do not reuse rewritten files cached by previous runs in the target dir.',)
+    parser.add_argument('--rewrite-engine', action='store', choices=('redbaron', 'ast'), dest='rewrite_engine', default='redbaron',
+                        help='Rewrite Python imports and strings using the lossless RedBaron FST or by splicing at stdlib AST/tokenize offsets.'
+                             ' The latter falls back to RedBaron for constructs it does not support.',)
+    parser.add_argument('--yaml-rewrite-mode', action='store', choices=('dump', 'patch'), dest='yaml_rewrite_mode', default='dump',
+                        help='Write rewritten YAML files by dumping the whole document or by patching the changed scalars'
+                             ' in the original text, which keeps the formatting and comments. The latter falls back to'
+                             ' dumping for changes it cannot locate in the text.',)
+    parser.add_argument('--git-fast-import', action='store_true', dest='git_fast_import', default=False,
+                        help='Create the collection git repos by streaming the files into a single "git fast-import" process'
+                             ' instead of running "git add" and "git commit".')
+    parser.add_argument('--profile', action='store_true', dest='profile', default=False,
+                        help='Profile building each collection with cProfile and save the stats under VARDIR/profile/')
+    parser.add_argument('--link-mode', action='store', choices=LINK_MODES, dest='link_mode', default='copy',
+                        help='How to materialize the files kept as is in the collections: "reflink" clones the data'
+                             ' where the filesystem supports it and copies otherwise, "hardlink" tries reflinks, then'
+                             ' hardlinks and copies as the last resort.')
+    parser.add_argument('--publish-jobs', action='store', type=positive_int, dest='publish_jobs', default=4,
+                        help='Publish this many collections concurrently, each deploy key push with its own temporary SSH key')
+    parser.add_argument('--publish-auth', action='store', choices=('deploy-key', 'app-token'), dest='publish_auth', default='deploy-key',
+                        help='Push the collections over SSH with a temporary deploy key added to and removed from each repo,'
+                             ' or over HTTPS with the GitHub App installation token revoked once all the pushes are done.')
+    parser.add_argument('--ssh-key-type', action='store', choices=KEY_TYPES, dest='ssh_key_type', default='ed25519',
+                        help='Type of the temporary SSH key used for the pushes')
+    parser.add_argument('--ssh-multiplex', action='store_true', dest='ssh_multiplex', default=False,
+                        help='Reuse one SSH ControlMaster connection per host for all the pushes of a publish session')
+    parser.add_argument('--resume', action='store_true', dest='resume', default=False,
+                        help='Skip the collections built by the previous run according to its checkpoints journal'
+                             ' and replay their contributions to the Core routing and removals.')
+    parser.add_argument('-j', '--jobs', action='store', type=positive_int, dest='jobs', default=1, help='build this many collections in parallel worker processes')
 
 
 def main():
@@ -2483,8 +4207,20 @@ def main():
 
     devel_path = os.path.join(args.vardir, 'releases', f'{DEVEL_BRANCH}.git')
 
+    timings_report_path = os.path.join(args.vardir, 'timings.json')
+    try:
+        with run_timer.phase('total'):
+            run_migration(args, spec, devel_path)
+    finally:
+        run_timer.write_report(timings_report_path, TIMINGS_TOP_N)
+        logger.info('Saved the timings report to %s', timings_report_path)
+
+
+def run_migration(args, spec, devel_path):
+    """Check out Core, migrate and publish as requested."""
     global ALL_THE_FILES
-    ALL_THE_FILES = checkout_repo(DEVEL_URL, devel_path, refresh=args.refresh)
+    with run_timer.phase('checkout'):
+        ALL_THE_FILES = checkout_repo(DEVEL_URL, devel_path, refresh=args.refresh)
 
     if args.skip_migration:
         logger.info('Skipping the migration...')
@@ -2517,33 +4253,47 @@ def main():
         print('======= Could not rewrite the following, ' 'please check manually =======\n',)
         print(yaml.dump(dict(manual_check)))
 
+        print('======= Python files per rewrite path =======\n')
+        print(yaml.dump(dict(rewrite_paths)))
+
         print(f'See {LOGFILE} for any warnings/errors ' 'that were logged during migration.',)
+        print(f'See {os.path.join(args.vardir, "timings.json")} for the time spent in each phase.')
 
     if args.skip_publish:
         logger.info('Skipping the publish step...')
         return
 
-    tmp_rsa_key = None
+    tmp_ssh_keys = []
     if args.publish_to_github or args.push_migrated_core:
         logger.info('Starting the publish step...')
-        tmp_rsa_key = RSAKey()
+        # octomachinery imports cryptography which runs without publishing don't need
+        from gh import GitHubOrgClient  # pylint: disable=import-outside-toplevel
+
+        # one key per concurrent push, a deploy key only fits one repo at a time;
+        # the keys themselves are only generated once a push needs them
+        tmp_ssh_keys = [
+            EphemeralSSHKey(args.ssh_key_type, ssh_multiplex=args.ssh_multiplex)
+            for _ in range(args.publish_jobs)
+        ]
         gh_api = GitHubOrgClient(
             args.github_app_id, args.github_app_key_path,
             args.target_github_org,
-            deployment_rsa_pub_key=tmp_rsa_key.public_openssh,
+            deployment_ssh_key=tmp_ssh_keys[0],
         )
-        logger.debug('Initialized a temporary RSA key and GitHub API client')
+        logger.debug('Initialized temporary SSH keys and GitHub API client')
 
     if args.publish_to_github:
         logger.info('Publishing the migrated collections to GitHub...')
         publish_to_github(
             args.vardir, spec,
-            gh_api, tmp_rsa_key,
+            gh_api, tmp_ssh_keys,
+            jobs=args.publish_jobs,
+            auth=args.publish_auth,
         )
 
     if args.push_migrated_core:
         logger.info('Publishing the migrated "Core" to GitHub...')
-        push_migrated_core(devel_path, gh_api, tmp_rsa_key, args.spec_dir)
+        push_migrated_core(devel_path, gh_api, tmp_ssh_keys[0], args.spec_dir)
 
 ### main execution
 
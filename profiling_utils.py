@@ -0,0 +1,121 @@
+"""Run timing and profiling helpers."""
+import contextlib
+import cProfile
+import heapq
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Optional
+
+
+class RunTimer:
+    """Accumulator of wall time spent in the migration phases.
+
+    Phases may nest, so their totals overlap. Events that take no
+    time of their own, like cache hits, are counted separately.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+        self.breakdown = defaultdict(lambda: defaultdict(float))
+        self.files = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def count(self, name: str, increment: int = 1):
+        """Count an event under the counter name."""
+        self.counters[name] += increment
+
+    @contextlib.contextmanager
+    def phase(self, name: str, key: Optional[str] = None, path: Optional[str] = None):
+        """Time the block under the phase name.
+
+        The time is also accounted to ``key`` in the phase
+        breakdown and to ``path`` in the per-file totals.
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started_at
+            self.phases[name]['calls'] += 1
+            self.phases[name]['seconds'] += elapsed
+            if key is not None:
+                self.breakdown[name][key] += elapsed
+            if path is not None:
+                self.files[(name, path)] += elapsed
+
+    def iter_phase(self, name: str, iterable, key: Optional[str] = None):
+        """Iterate over the iterable timing the whole loop under the phase name."""
+        with self.phase(name, key=key):
+            yield from iterable
+
+    def snapshot(self) -> dict:
+        """Return the accumulated timings as a picklable dict."""
+        return {
+            'phases': {name: dict(totals) for name, totals in self.phases.items()},
+            'breakdown': {name: dict(keys) for name, keys in self.breakdown.items()},
+            'files': dict(self.files),
+            'counters': dict(self.counters),
+        }
+
+    def merge(self, snapshot: dict):
+        """Add the timings from a snapshot of another timer."""
+        for name, totals in snapshot['phases'].items():
+            self.phases[name]['calls'] += totals['calls']
+            self.phases[name]['seconds'] += totals['seconds']
+        for name, keys in snapshot['breakdown'].items():
+            for key, seconds in keys.items():
+                self.breakdown[name][key] += seconds
+        for name_n_path, seconds in snapshot['files'].items():
+            self.files[name_n_path] += seconds
+        for name, count in snapshot['counters'].items():
+            self.counters[name] += count
+
+    def report(self, top_n: int) -> dict:
+        """Return the JSON-serializable timings report."""
+        slowest_files = heapq.nlargest(top_n, self.files.items(), key=lambda item: item[1])
+        return {
+            'phases': {
+                name: {'calls': totals['calls'], 'seconds': round(totals['seconds'], 6)}
+                for name, totals in sorted(self.phases.items(), key=lambda item: -item[1]['seconds'])
+            },
+            'breakdown': {
+                name: {
+                    key: round(seconds, 6)
+                    for key, seconds in sorted(keys.items(), key=lambda item: -item[1])
+                }
+                for name, keys in self.breakdown.items()
+            },
+            'slowest_files': [
+                {'phase': name, 'path': path, 'seconds': round(seconds, 6)}
+                for (name, path), seconds in slowest_files
+            ],
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def write_report(self, report_path: str, top_n: int):
+        """Save the timings report as JSON."""
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+        with open(report_path, 'w') as report_file:
+            json.dump(self.report(top_n), report_file, indent=2)
+
+
+@contextlib.contextmanager
+def profile_into(pstats_path: Optional[str]):
+    """Profile the block with cProfile if a path to save stats to is set."""
+    if pstats_path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(pstats_path), exist_ok=True)
+        profiler.dump_stats(pstats_path)
@@ -1,74 +1,147 @@
-"""In-memory RSA key generation and management utils."""
+"""In-memory SSH key generation and management utils.
+
+``cryptography`` is only imported once a key is actually generated.
+"""
 from __future__ import annotations
 
+import asyncio
 import contextlib
 import functools
 import os
+import shutil
 import subprocess
+import tempfile
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric.rsa import generate_private_key
-from cryptography.hazmat.primitives.serialization import (
-    Encoding,
-    NoEncryption,
-    PublicFormat,
-    PrivateFormat,
-)
+from logzero import logger
 
 
-class RSAKey:
-    """In-memory RSA key wrapper."""
+KEY_TYPES = 'ed25519', 'rsa'
 
-    def __init__(self):
-        _rsa_key_obj = generate_private_key(
-            public_exponent=65537,
-            key_size=4096,
-            backend=default_backend(),
-        )
 
-        _rsa_pub_key_obj = _rsa_key_obj.public_key()
-        self._public_repr = _rsa_pub_key_obj.public_bytes(
-            encoding=Encoding.PEM,
-            format=PublicFormat.PKCS1,
-        ).decode()
-        self._public_repr_openssh = _rsa_pub_key_obj.public_bytes(
-            encoding=Encoding.OpenSSH,
-            format=PublicFormat.OpenSSH,
-        ).decode()
+class EphemeralSSHKey:
+    """In-memory SSH key wrapper.
 
-        _private_rsa_key_repr = _rsa_key_obj.private_bytes(
-            encoding=Encoding.PEM,
-            format=PrivateFormat.TraditionalOpenSSL,  # A.K.A. PKCS#1
-            encryption_algorithm=NoEncryption(),
-        )
-        self._ssh_agent_cm = SSHAgent(_private_rsa_key_repr)
+    The key is generated on first use. With ``ssh_multiplex``, the
+    SSH agent sessions share connections through a ControlMaster.
+    """
+
+    def __init__(self, key_type: str = 'ed25519', *, ssh_multiplex: bool = False):
+        if key_type not in KEY_TYPES:
+            raise ValueError(f'Unsupported SSH key type: {key_type}')
+        self._key_type = key_type
+        self._ssh_multiplex = ssh_multiplex
+        self._key_reprs_cache = None
+        self._ssh_agent_cm = None
+
+    @property
+    def _key_reprs(self) -> dict:
+        if self._key_reprs_cache is None:
+            self._key_reprs_cache = _generate_key_reprs(self._key_type)
+        return self._key_reprs_cache
 
     @property
     def ssh_agent(self) -> SSHAgent:
         """SSH agent CM."""
+        if self._ssh_agent_cm is None:
+            self._ssh_agent_cm = SSHAgent(
+                self._key_reprs['private'], multiplex=self._ssh_multiplex,
+            )
         return self._ssh_agent_cm
 
     @property
     def public(self) -> str:
-        """String PKCS#1-formatted representation of the public key."""
-        return self._public_repr
+        """String PEM-formatted representation of the public key.
+
+        It is PKCS#1 for RSA keys and SubjectPublicKeyInfo otherwise.
+        """
+        return self._key_reprs['public']
 
     @property
     def public_openssh(self) -> str:
         """String OpenSSH-formatted representation of the public key."""
-        return self._public_repr_openssh
+        return self._key_reprs['public_openssh']
+
+
+class RSAKey(EphemeralSSHKey):
+    """In-memory RSA key wrapper."""
+
+    def __init__(self):
+        super().__init__('rsa')
+
+
+def _generate_key_reprs(key_type: str) -> dict:
+    """Generate a private key and serialize it with its public key."""
+    # pylint: disable=import-outside-toplevel
+    from cryptography.hazmat.primitives.serialization import (
+        Encoding,
+        NoEncryption,
+        PublicFormat,
+        PrivateFormat,
+    )
+
+    if key_type == 'ed25519' and not hasattr(PrivateFormat, 'OpenSSH'):
+        logger.warning(
+            'cryptography is too old to serialize Ed25519 keys for ssh-add, '
+            'falling back to RSA',
+        )
+        key_type = 'rsa'
+
+    if key_type == 'ed25519':
+        # pylint: disable=import-outside-toplevel
+        from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+            Ed25519PrivateKey,
+        )
+        _key_obj = Ed25519PrivateKey.generate()
+        private_format = PrivateFormat.OpenSSH
+        public_format = PublicFormat.SubjectPublicKeyInfo
+    else:
+        # pylint: disable=import-outside-toplevel
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.asymmetric.rsa import (
+            generate_private_key,
+        )
+        _key_obj = generate_private_key(
+            public_exponent=65537,
+            key_size=4096,
+            backend=default_backend(),
+        )
+        private_format = PrivateFormat.TraditionalOpenSSL  # A.K.A. PKCS#1
+        public_format = PublicFormat.PKCS1
+
+    _pub_key_obj = _key_obj.public_key()
+    return {
+        'public': _pub_key_obj.public_bytes(
+            encoding=Encoding.PEM,
+            format=public_format,
+        ).decode(),
+        'public_openssh': _pub_key_obj.public_bytes(
+            encoding=Encoding.OpenSSH,
+            format=PublicFormat.OpenSSH,
+        ).decode(),
+        'private': _key_obj.private_bytes(
+            encoding=Encoding.PEM,
+            format=private_format,
+            encryption_algorithm=NoEncryption(),
+        ),
+    }
 
 
 class SSHAgent:
     """SSH agent lifetime manager.
 
-    Only usable as a CM. Only holds one RSA key in memory.
+    Only usable as a CM. Only holds one key in memory.
+
+    When multiplexing, the SSH connections made through the proxy
+    to the same host reuse one master connection. Its control socket
+    lives in a private temp dir for the lifetime of the CM.
     """
 
-    def __init__(self, ssh_key: bytes):
+    def __init__(self, ssh_key: bytes, *, multiplex: bool = False):
         self._ssh_key = ssh_key
         self._ssh_agent_proc = None
         self._ssh_agent_socket = None
+        self._multiplex = multiplex
+        self._control_dir = None
 
     def __enter__(self) -> _SubprocessSSHAgentProxy:
         ssh_agent_cmd = (
@@ -90,7 +163,19 @@ class SSHAgent:
             partition('=')[-1]
         )
 
-        subprocess_proxy = _SubprocessSSHAgentProxy(self._ssh_agent_socket)
+        ssh_options = ()
+        if self._multiplex:
+            self._control_dir = tempfile.mkdtemp(prefix='ssh-mux-')
+            control_path = os.path.join(self._control_dir, '%C')
+            ssh_options = (
+                '-o ControlMaster=auto',
+                f'-o ControlPath="{control_path}"',
+                '-o ControlPersist=yes',
+            )
+
+        subprocess_proxy = _SubprocessSSHAgentProxy(
+            self._ssh_agent_socket, ssh_options,
+        )
         subprocess_proxy.check_output(
             ssh_add_cmd,
             input=self._ssh_key,
@@ -101,9 +186,14 @@ class SSHAgent:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         ssh_agent_proc = self._ssh_agent_proc
+        control_dir = self._control_dir
 
         self._ssh_agent_socket = None
         self._ssh_agent_proc = None
+        self._control_dir = None
+
+        if control_dir is not None:
+            _stop_ssh_control_masters(control_dir)
 
         with contextlib.suppress(IOError, OSError):
             ssh_agent_proc.terminate()
@@ -111,6 +201,23 @@ class SSHAgent:
         return False
 
 
+def _stop_ssh_control_masters(control_dir):
+    """Ask the masters listening in the dir to exit and drop the dir."""
+    for control_socket in os.listdir(control_dir):
+        ssh_exit_cmd = (
+            'ssh', '-F', '/dev/null',
+            '-o', f'ControlPath={os.path.join(control_dir, control_socket)}',
+            '-O', 'exit',  # man 1 ssh: request the master to exit
+            'control-master',  # the destination is not used but required
+        )
+        with contextlib.suppress(IOError, OSError):
+            subprocess.run(
+                ssh_exit_cmd,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+    shutil.rmtree(control_dir, ignore_errors=True)
+
+
 def pre_populate_env_kwarg(meth):
     """Pre-populated env arg in decorated methods."""
     @functools.wraps(meth)
@@ -123,6 +230,7 @@ def pre_populate_env_kwarg(meth):
             '-o PreferredAuthentications=publickey '
             '-o IdentityFile=/dev/null '
             f'-o IdentityAgent="{self._sock}"'
+            + ''.join(f' {ssh_option}' for ssh_option in self._ssh_options)
         )
         kwargs['env']['SSH_AUTH_SOCK'] = self._sock
         return meth(self, *args, **kwargs)
@@ -133,8 +241,9 @@ def pre_populate_env_kwarg(meth):
 class _SubprocessSSHAgentProxy:
     """Proxy object for calls to subprocess functions."""
 
-    def __init__(self, sock):
+    def __init__(self, sock, ssh_options=()):
         self._sock = sock
+        self._ssh_options = ssh_options
 
     @pre_populate_env_kwarg
     def check_call(self, *args, **kwargs):
@@ -150,3 +259,8 @@ class _SubprocessSSHAgentProxy:
     def run(self, *args, **kwargs):
         """Populate the SSH agent sock into the run env."""
         return subprocess.run(*args, **kwargs)
+
+    @pre_populate_env_kwarg
+    def create_subprocess_exec(self, *args, **kwargs):
+        """Populate the SSH agent sock into the asyncio subprocess env."""
+        return asyncio.create_subprocess_exec(*args, **kwargs)
@@ -0,0 +1,213 @@
+"""Offset-based Python source rewriting helpers."""
+import ast
+import bisect
+import io
+import re
+import tokenize
+from typing import List, NamedTuple, Optional, Tuple
+
+
+NON_CODE_TOKENS = frozenset({
+    tokenize.COMMENT,
+    tokenize.DEDENT,
+    tokenize.INDENT,
+    tokenize.NL,
+})
+
+
+class UnsupportedSourceLayout(Exception):
+    """The source construct cannot be rewritten by splicing."""
+
+
+class Token(NamedTuple):
+    """Token with character offsets into the module source."""
+
+    type: int
+    string: str
+    start: int
+    end: int
+
+
+class ImportStmt(NamedTuple):
+    """Import statement along with the location of its dotted name."""
+
+    node: ast.AST
+    type: str  # 'import' or 'from_import' like in RedBaron
+    level: int
+    name_start: Optional[int]
+    name_end: Optional[int]
+    name_parts: Tuple[str, ...]
+    targets: Optional[List[str]]
+
+
+class SourceSplicer:
+    """Python module source with text edits keyed by character offsets.
+
+    Nodes are located with the stdlib ``ast`` and ``tokenize``
+    modules and replacements are spliced into the original text,
+    so everything that is not replaced is preserved byte for byte.
+    """
+
+    def __init__(self, src_text: str):
+        self.src_text = src_text
+        try:
+            self.mod_ast = ast.parse(src_text)
+            self._lines = src_text.split('\n')
+            self._line_starts = [0] + [m.end() for m in re.finditer('\n', src_text)]
+            self.tokens = [
+                Token(
+                    tok.type, tok.string,
+                    self.offset_of(*tok.start), self.offset_of(*tok.end),
+                )
+                for tok in tokenize.generate_tokens(io.StringIO(src_text).readline)
+            ]
+        except (SyntaxError, ValueError, tokenize.TokenError) as exc:
+            raise UnsupportedSourceLayout(str(exc)) from exc
+        self._token_starts = [t.start for t in self.tokens]
+        self._edits = {}
+
+    def offset_of(self, lineno: int, col: int) -> int:
+        """Convert a tokenize (row, col) position into a char offset."""
+        if lineno > len(self._line_starts):
+            return len(self.src_text)
+        return self._line_starts[lineno - 1] + col
+
+    def node_offset(self, node: ast.AST) -> int:
+        """Return the char offset of an AST node start.
+
+        The AST column offsets are in UTF-8 bytes, not in chars.
+        """
+        line = self._lines[node.lineno - 1]
+        col = len(line.encode('utf-8')[:node.col_offset].decode('utf-8', errors='ignore'))
+        return self._line_starts[node.lineno - 1] + col
+
+    def token_index_at(self, offset: int) -> int:
+        """Return the index of the first code token at the offset."""
+        tok_idx = bisect.bisect_left(self._token_starts, offset)
+        while tok_idx < len(self.tokens) and self.tokens[tok_idx].type in NON_CODE_TOKENS:
+            tok_idx += 1
+        if tok_idx == len(self.tokens) or self.tokens[tok_idx].start != offset:
+            raise UnsupportedSourceLayout(f'No token starts at offset {offset}')
+        return tok_idx
+
+    def _next_code_token_index(self, tok_idx: int) -> int:
+        tok_idx += 1
+        while self.tokens[tok_idx].type in NON_CODE_TOKENS:
+            tok_idx += 1
+        return tok_idx
+
+    def dotted_name_at(self, tok_idx: int) -> Tuple[int, int, Tuple[str, ...], int]:
+        """Parse a ``NAME ('.' NAME)*`` sequence starting at the token.
+
+        Return its start and end offsets, the name parts
+        and the index of the token following it.
+        """
+        parts = []
+        start = self.tokens[tok_idx].start
+        while True:
+            tok = self.tokens[tok_idx]
+            if tok.type != tokenize.NAME:
+                raise UnsupportedSourceLayout(f'Expected a name at offset {tok.start}')
+            parts.append(tok.string)
+            end = tok.end
+            tok_idx = self._next_code_token_index(tok_idx)
+            if self.tokens[tok_idx].string != '.':
+                return start, end, tuple(parts), tok_idx
+            tok_idx = self._next_code_token_index(tok_idx)
+
+    def nodes_of_type(self, node_types, root: Optional[ast.AST] = None) -> List[ast.AST]:
+        """Return AST nodes of the given types in the document order."""
+        return sorted(
+            (
+                node for node in ast.walk(self.mod_ast if root is None else root)
+                if isinstance(node, node_types)
+            ),
+            key=lambda node: (node.lineno, node.col_offset),
+        )
+
+    def imports(self) -> List[ImportStmt]:
+        """Return all the import statements in the document order.
+
+        For ``import a.b, c`` only the first dotted name is located,
+        this matches what the RedBaron based rewriters look at.
+        """
+        import_stmts = []
+        for node in self.nodes_of_type((ast.Import, ast.ImportFrom)):
+            tok_idx = self._next_code_token_index(self.token_index_at(self.node_offset(node)))
+            if isinstance(node, ast.Import):
+                name_start, name_end, name_parts, _tok_idx = self.dotted_name_at(tok_idx)
+                import_stmts.append(ImportStmt(node, 'import', 0, name_start, name_end, name_parts, None))
+                continue
+
+            while self.tokens[tok_idx].string in {'.', '...'}:
+                tok_idx = self._next_code_token_index(tok_idx)
+            name_start = name_end = None
+            name_parts = ()
+            if node.module:
+                name_start, name_end, name_parts, _tok_idx = self.dotted_name_at(tok_idx)
+            import_stmts.append(ImportStmt(
+                node, 'from_import', node.level,
+                name_start, name_end, name_parts,
+                [alias.name for alias in node.names],
+            ))
+        return import_stmts
+
+    def string_literals(self) -> List[Token]:
+        """Return string literal tokens without any prefix."""
+        return [
+            tok for tok in self.tokens
+            if tok.type == tokenize.STRING and tok.string[0] in {'"', "'"}
+        ]
+
+    def assigned_value_tokens(self, node: ast.Assign) -> List[Token]:
+        """Return the tokens of the value assigned in a statement.
+
+        Only plain literals are supported: parenthesized
+        or compound expressions raise :exc:`UnsupportedSourceLayout`.
+        """
+        tok_idx = self.token_index_at(self.node_offset(node))
+        value_idx = None
+        depth = 0
+        while self.tokens[tok_idx].type not in {tokenize.NEWLINE, tokenize.ENDMARKER}:
+            tok = self.tokens[tok_idx]
+            if tok.string in {'(', '[', '{'}:
+                depth += 1
+            elif tok.string in {')', ']', '}'}:
+                depth -= 1
+            elif tok.string == '=' and depth == 0:
+                value_idx = self._next_code_token_index(tok_idx)
+            elif tok.string == ';' and depth == 0:
+                break
+            tok_idx += 1
+
+        if value_idx is None:
+            raise UnsupportedSourceLayout('Could not locate the assigned value')
+
+        value_tokens = []
+        while self.tokens[value_idx].type not in {tokenize.NEWLINE, tokenize.ENDMARKER} and self.tokens[value_idx].string != ';':
+            value_tokens.append(self.tokens[value_idx])
+            value_idx = self._next_code_token_index(value_idx)
+
+        if len(value_tokens) > 1 and any(t.type != tokenize.STRING for t in value_tokens):
+            raise UnsupportedSourceLayout('Only plain literals are supported as assigned values')
+        return value_tokens
+
+    def replace(self, start: int, end: int, text: str):
+        """Schedule replacing the source range with the text."""
+        self._edits[(start, end)] = text
+
+    def text_of(self, start: int, end: int) -> str:
+        """Return the source range text, with the scheduled edit applied."""
+        return self._edits.get((start, end), self.src_text[start:end])
+
+    def dumps(self) -> str:
+        """Return the source with all the edits spliced in."""
+        chunks = []
+        pos = 0
+        for (start, end), text in sorted(self._edits.items()):
+            if start < pos:
+                raise UnsupportedSourceLayout('Overlapping edits')
+            chunks.extend((self.src_text[pos:start], text))
+            pos = end
+        chunks.append(self.src_text[pos:])
+        return ''.join(chunks)
@@ -0,0 +1,64 @@
+import glob
+import os
+
+import pytest
+
+import migrate
+
+
+TREE = (
+    'a/x.py',
+    'a/p.py',
+    'a/q.py',
+    'a/^q.py',
+    'a/!q.py',
+    'a/.h.py',
+    'a/b/y.py',
+    'a/b/.i.py',
+    'a/b/c/z.py',
+    'a/.d/z.py',
+    'a/.d/e/w.py',
+    'f/z.py',
+)
+
+
+@pytest.fixture(scope='module')
+def tree(tmp_path_factory):
+    root = tmp_path_factory.mktemp('tree')
+    for path in TREE:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text('')
+    return str(root)
+
+
+@pytest.mark.parametrize('pattern', (
+    'a/**',
+    'a/**/*.py',
+    'a/**/.*.py',
+    'a/b/**',
+    '**/z.py',
+    '**',
+    'a/*',
+    'a/*/c',
+    'a/*/*.py',
+    'a/.*',
+    'a/.d/*',
+    'a/.d/**',
+    'a/?.py',
+    'a/[pq].py',
+    'a/[!q].py',
+    'a/[^q].py',
+    'a/[!^q].py',
+    'a/[.]h.py',
+    'a/b/c/z.py',
+    'n*/**',
+    'a/?/**',
+    'a/*.txt',
+))
+def test_tracked_paths_glob_matches_glob(tree, pattern):
+    globbed = [os.path.relpath(path, tree) for path in glob.glob(os.path.join(tree, pattern), recursive=True)]
+    expected_files = sorted(path for path in globbed if os.path.isfile(os.path.join(tree, path)))
+
+    files, matched = migrate.TrackedPaths(TREE).glob(pattern)
+
+    assert (sorted(files), matched) == (expected_files, bool(globbed))
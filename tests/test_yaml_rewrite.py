@@ -0,0 +1,77 @@
+import argparse
+
+from ansible.parsing.yaml.loader import AnsibleLoader
+
+import migrate
+
+
+SPEC = {
+    'community': {
+        'general': {
+            'modules': ['cloud/amazon/ec2.py'],
+            'lookup': ['hashi_vault.py'],
+        },
+    },
+}
+
+TASKS = '''\
+---
+# keep this comment
+- name: Launch an instance
+  ec2:  # and this one
+    image: ami-123456
+    wait: yes
+
+- name: Read the secrets
+  debug:
+    msg: "{{ item }}"
+  with_hashi_vault:
+  - 'secret=secret/hello'
+'''
+
+EXPECTED_TASKS = '''\
+---
+# keep this comment
+- name: Launch an instance
+  community.general.ec2:  # and this one
+    image: ami-123456
+    wait: yes
+
+- name: Read the secrets
+  debug:
+    msg: "{{ item }}"
+  with_community.general.hashi_vault:
+  - 'secret=secret/hello'
+'''
+
+
+def test_rewrite_yaml_in_place_patches_plain_keys(tmp_path):
+    src = tmp_path / 'src.yml'
+    dest = tmp_path / 'dest.yml'
+    src.write_text(TASKS)
+    args = argparse.Namespace(fail_on_core_rewrite=False, link_mode='copy', vardir=str(tmp_path))
+
+    migrate.rewrite_yaml_in_place(str(src), str(dest), 'ansible', 'test', SPEC, args, str(tmp_path))
+
+    patched_text = dest.read_text()
+    assert patched_text == EXPECTED_TASKS
+    assert AnsibleLoader(patched_text).get_single_data() == [
+        {'name': 'Launch an instance', 'community.general.ec2': {'image': 'ami-123456', 'wait': True}},
+        {'name': 'Read the secrets', 'debug': {'msg': '{{ item }}'}, 'with_community.general.hashi_vault': ['secret=secret/hello']},
+    ]
+
+
+def test_plain_scalar_replacement_with_libyaml_style():
+    text = 'a: b\n'
+    node = AnsibleLoader(text).get_single_node().value[0][0]
+    assert migrate.get_yaml_scalar_replacement(text, node, 'ns.coll.a') == 'ns.coll.a'
+
+
+def test_module_in_two_subdirs_of_a_collection_is_renamed_once():
+    spec = {'community': {'general': {'modules': ['cloud/amazon/ec2.py', 'legacy/ec2.py']}}}
+    args = argparse.Namespace(fail_on_core_rewrite=False)
+    task = {'name': 'Launch an instance', 'ec2': {'image': 'ami-123456'}}
+
+    migrate._rewrite_yaml_mapping_keys_non_vars(task, 'ansible', 'test', spec, args, 'dest.yml')
+
+    assert task == {'name': 'Launch an instance', 'community.general.ec2': {'image': 'ami-123456'}}